@@ -3,6 +3,7 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Security
 from typing import Optional, List, Dict, Any
 from enum import Enum, auto
+from functools import lru_cache
 from supabase import create_client, Client
 
 # Create a router for this API
@@ -52,8 +53,13 @@ class Permissions:
     MANAGE_SANDBOX = "manage_sandbox"
     IMPORT_DATA = "import_data"
 
+@lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
-    """Returns an initialized Supabase client with admin privileges"""
+    """Returns the shared Supabase client with admin privileges
+    
+    The client is created once per process so every permission check reuses
+    the same HTTP connection pool instead of opening a new TLS session.
+    """
     import databutton as db
     
     supabase_url = db.secrets.get("SUPABASE_URL")
@@ -5,9 +5,8 @@
 import jwt
 import databutton as db
 from fastapi import APIRouter, Depends, HTTPException, Header, Request # Added APIRouter
-from app.apis.admin_permissions import get_user_role, AdminRole, has_permission, Permissions
+from app.apis.admin_permissions import get_user_role, AdminRole, has_permission, Permissions, get_supabase_client
 from app.env import Mode, mode
-from supabase import create_client  # Add missing import
 
 # Try to import test utilities (will fail in production but that's okay)
 try:
@@ -224,10 +223,8 @@ async def verify_premium_subscription(user_info: tuple = Depends(get_current_use
     
     # Get the user's profile from Supabase to check subscription tier
     try:
-        # Get Supabase credentials
-        supabase_url = db.secrets.get("SUPABASE_URL")
-        supabase_key = db.secrets.get("SUPABASE_SERVICE_ROLE_KEY")
-        supabase = create_client(supabase_url, supabase_key)
+        # Reuse the shared service role client
+        supabase = get_supabase_client()
         
         # Get user profile
         profile_response = supabase.table("profiles").select("subscription_tier").eq("id", user_id).execute()
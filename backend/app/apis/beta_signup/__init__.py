@@ -19,9 +19,11 @@ class BetaSignupResponse(BaseModel):
     success: bool
     message: str
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 # Sanitize storage key to only allow alphanumeric and ._- symbols
 def sanitize_storage_key(key: str) -> str:
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
 
 # Function to initialize the supabase client
 def get_supabase_client() -> Client:
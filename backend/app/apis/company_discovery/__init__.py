@@ -53,9 +53,11 @@ class CompanyPair(BaseModel):
     date: str
 
 # Helper functions
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
 
 def get_storage_key_for_exchange(exchange: str) -> str:
     """Generate a storage key for a specific exchange's company listings"""
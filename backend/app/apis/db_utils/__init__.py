@@ -1,15 +1,21 @@
 # src/app/apis/db_utils/__init__.py
 # Utility functions for database operations
 
+import re
 import databutton as db
+from functools import lru_cache
 from supabase import create_client
 from fastapi import APIRouter, HTTPException
 
 # Create a dummy router to satisfy the framework
 router = APIRouter()
 
+@lru_cache(maxsize=1)
 def get_supabase_client():
-    """Get a Supabase client instance using credentials from secrets
+    """Get the shared Supabase client instance using credentials from secrets
+    
+    The client is created on first use and reused afterwards, so callers share
+    one HTTP connection pool. A failed creation is not cached.
     
     Returns:
         A Supabase client instance that can be used to interact with the database
@@ -37,6 +43,8 @@ def get_supabase_client():
             detail=f"Database connection error: {str(e)}"
         ) from e
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key):
     """Sanitize a storage key to ensure it only contains safe characters
     
@@ -46,5 +54,4 @@ def sanitize_storage_key(key):
     Returns:
         A sanitized key that can be safely used with db.storage
     """
-    import re
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
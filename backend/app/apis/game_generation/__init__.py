@@ -62,9 +62,11 @@ class GameGenerationResponse(BaseModel):
     is_saved: bool = False
 
 # Helper functions
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
 
 def fetch_financial_data(ticker: str, period: str = "1mo") -> pd.DataFrame:
     """Fetch financial data for a ticker using yfinance"""
@@ -227,15 +229,19 @@ def save_game_to_supabase(game_data: GameGenerationResponse, exchange: str) -> b
             "status": game_data.status
         }
         
-        # Insert into database
-        response = supabase.table(table_name).insert(insert_data).execute()
+        # Upsert into database - relies on the unique (exchange, game_date) index (see
+        # migration_docs PREDICTIONS_SQL) so concurrent generators cannot both insert a
+        # game for the same day
+        response = supabase.table(table_name)\
+            .upsert(insert_data, on_conflict="exchange,game_date", ignore_duplicates=True)\
+            .execute()
         
-        # Check if insert was successful
+        # Check if a row was written (an ignored duplicate returns no rows)
         if response.data and len(response.data) > 0:
             print(f"[INFO] Successfully saved game to {table_name} table")
             return True
         else:
-            print(f"[WARNING] Insert response didn't contain data: {response}")
+            print(f"[WARNING] Game for {exchange.upper()} on {game_data.game_date} already exists, nothing saved")
             return False
     except Exception as e:
         print(f"[ERROR] Failed to save game to Supabase: {str(e)}")
@@ -358,19 +364,21 @@ def generate_upcoming_games_task(days_ahead: int = 1):
             for i in range(days_ahead):
                 target_date = (next_day + timedelta(days=i)).isoformat()
                 
-                # Check if a game already exists for this date
+                # Check if a game already exists for this date (HEAD request, count only)
+                # Kept so we don't pay for AI generation on days that are already filled;
+                # the upsert in save_game_to_supabase covers the remaining race.
                 from app.apis.predictions_api import get_supabase_admin_client
                 supabase = get_supabase_admin_client()
                 table_name = "asx_games" if exchange.upper() == "ASX" else "nyse_games"
                 
                 response = supabase.table(table_name)\
-                    .select("pair_id")\
+                    .select("game_date", count="exact", head=True)\
+                    .eq("exchange", exchange.upper())\
                     .eq("game_date", target_date)\
-                    .limit(1)\
                     .execute()
                 
                 # Skip if game already exists
-                if response.data and len(response.data) > 0:
+                if response.count:
                     print(f"[INFO] Game already exists for {exchange} on {target_date}, skipping generation")
                     continue
                 
@@ -1,10 +1,15 @@
 import os
-from fastapi import APIRouter, Depends, Query, Path, HTTPException
+from fastapi import APIRouter, Depends, Query, Path, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, NamedTuple, Optional, Tuple
 import databutton as db
 from supabase import create_client, Client, PostgrestAPIResponse
 import math
+import hashlib
+import threading
+import orjson
+from cachetools import TTLCache
 from app.apis.auth_utils import get_current_user # Assuming auth_utils provides user info
 
 # --- Supabase Client Initialization ---
@@ -18,6 +23,39 @@ if not supabase_url or not supabase_key:
 supabase: Client = create_client(supabase_url, supabase_key)
 # --- End Supabase Client Initialization ---
 
+# --- Response Cache ---
+# Leaderboard pages are identical for every authenticated user, so they are cached
+# per (exchange, limit, offset) and never per user.
+# The stale cache keeps the last good page for longer so it can be served when
+# Supabase is unavailable. Pages are stored as serialized JSON bytes, so hits skip
+# both validation and encoding. Each page is stored with an ETag derived from its
+# bytes so pollers holding the current page get a bodyless 304.
+LEADERBOARD_CACHE_TTL_SECONDS = 30
+LEADERBOARD_STALE_TTL_SECONDS = 60 * 60
+_leaderboard_cache: TTLCache = TTLCache(maxsize=256, ttl=LEADERBOARD_CACHE_TTL_SECONDS)
+_stale_leaderboard_cache: TTLCache = TTLCache(maxsize=256, ttl=LEADERBOARD_STALE_TTL_SECONDS)
+_leaderboard_cache_lock = threading.Lock() # Sync endpoint runs in the threadpool
+
+def _cache_leaderboard(cache_key: tuple, leaderboard_response) -> Tuple[bytes, str]:
+    """Serialize a leaderboard page and store it with its ETag in the fresh and the stale cache."""
+    body = orjson.dumps(leaderboard_response.model_dump())
+    etag = '"' + hashlib.blake2b(repr(cache_key).encode() + body, digest_size=16).hexdigest() + '"'
+    with _leaderboard_cache_lock:
+        _leaderboard_cache[cache_key] = (body, etag)
+        _stale_leaderboard_cache[cache_key] = (body, etag)
+    return body, etag
+
+def _json_response(request: Request, cached_page: Tuple[bytes, str], headers: Optional[dict] = None) -> Response:
+    """Wrap already-serialized JSON bytes in a response, or a 304 if the client's ETag matches."""
+    body, etag = cached_page
+    response_headers = {"ETag": etag, "Cache-Control": f"private, max-age={LEADERBOARD_CACHE_TTL_SECONDS}"}
+    if headers:
+        response_headers.update(headers)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=response_headers)
+    return Response(content=body, media_type="application/json", headers=response_headers)
+# --- End Response Cache ---
+
 
 # --- Pydantic Models ---
 # Updated models reflecting the new requirements
@@ -32,6 +70,17 @@ class LeaderboardEntry(BaseModel):
     avg_score: Optional[float] = Field(None, description="Average points scored per game based on calculate_game_score")
     # streak: int # Removed as per comment, use only for tie-breaking internally
 
+class LeaderboardRow(NamedTuple):
+    """One row returned by the get_leaderboard SQL function."""
+    rank: Optional[int] # None only on the "page past the end" row
+    player_id: Optional[str]
+    username: Optional[str]
+    games_played: Optional[int]
+    accuracy_percent: Optional[float]
+    avg_speed_ms: Optional[float]
+    avg_score: Optional[float]
+    total_players: int
+
 class LeaderboardResponse(BaseModel):
     leaderboard: List[LeaderboardEntry]
     total_players: int = Field(..., description="Total number of eligible players on this leaderboard (played >= 1 game)")
@@ -41,8 +90,9 @@ class LeaderboardResponse(BaseModel):
 
 router = APIRouter()
 
-@router.get("/leaderboard/{exchange}", response_model=LeaderboardResponse, summary="Get Leaderboard", description="Retrieves the ranked leaderboard for a specific exchange based on accuracy, speed, and streak.")
+@router.get("/leaderboard/{exchange}", response_class=ORJSONResponse, response_model=LeaderboardResponse, summary="Get Leaderboard", description="Retrieves the ranked leaderboard for a specific exchange based on accuracy, speed, and streak.")
 def get_leaderboard(
+    request: Request,
     exchange: str = Path(..., description="The exchange identifier (e.g., 'asx', 'nyse') for the leaderboard"),
     limit: int = Query(10, ge=1, le=50, description="Number of results to return (max 50)"),
     offset: int = Query(0, ge=0, description="Offset for pagination"),
@@ -56,147 +106,86 @@ def get_leaderboard(
 
     Only includes players who have played at least one game.
     Requires authentication.
+
+    If Supabase fails, the last good page (up to an hour old) is returned with
+    an `X-Cache: stale` header instead of a 500.
+
+    Responses carry an `ETag`; a request whose `If-None-Match` matches the
+    current page gets a `304 Not Modified` with no body.
     """
     print(f"Fetching leaderboard for exchange: {exchange}, limit: {limit}, offset: {offset}")
     requesting_user_id, _ = user_info # Extract user ID from auth dependency
 
+    cache_key = (exchange, limit, offset)
+    with _leaderboard_cache_lock:
+        cached_page = _leaderboard_cache.get(cache_key)
+    if cached_page is not None:
+        print(f"Serving cached leaderboard for exchange {exchange}, limit: {limit}, offset: {offset}")
+        return _json_response(request, cached_page)
+
+    # Step 1: Fetch one ranked page from Postgres.
+    # The get_leaderboard SQL function (see migration_docs LEADERBOARD_SQL) reads
+    # the leaderboard_mv materialized view, which is refreshed on every stats write
+    # and ranks players with RANK() (ties share a rank) over the ordering below.
+    # It returns only the `limit` rows after `offset` in (rank, player_id) order, with
+    # usernames joined from profiles and the total number of eligible players
+    # repeated on every row:
+    # 1. accuracy_percent DESC
+    # 2. avg_speed_ms ASC (no timing data sorts last)
+    # 3. current_streak DESC
+    # Only the RPC is guarded: supabase-py raises APIError on a failed call, which is
+    # the one failure that can fall back to the stale page.
     try:
-        # Define columns to select, including calculated fields alias if possible,
-        # or base columns needed for calculation.
-        # Note: Direct calculation within Supabase select might need complex syntax or DB functions.
-        # Fetching base columns and calculating here is often more straightforward.
-        # We need: user_id, exchange, total_games_played, total_correct,
-        # total_submission_time_correct_ms, current_streak, total_points_raw (if needed for avg_score)
-        # We also need the username. Assuming a 'profiles' table linked to auth.users via 'id'.
-
-        # Step 1: Query base data (player_exchange_stats only)
-        stats_query = (
-            supabase.table("player_exchange_stats")
-            .select(
-                """
-                player_id,
-                exchange_code,
-                games_played,
-                total_correct,
-                total_time_milliseconds,
-                current_streak,
-                total_score
-                """
-            )
-            .eq("exchange_code", exchange)
-            .gt("games_played", 0) # Only players who have played at least 1 game
-        )
-
-        # Execute the stats query
-        stats_response: PostgrestAPIResponse = stats_query.execute()
-
-        if stats_response.data is None:
-             print(f"Error fetching data from player_exchange_stats for exchange {exchange}. Response: {stats_response}")
-             raise HTTPException(status_code=500, detail=f"Failed to fetch player stats data for exchange {exchange}")
-
-        if not stats_response.data:
-             print(f"No player stats found for exchange {exchange}")
-             # Return empty leaderboard if no stats found
-             return LeaderboardResponse(leaderboard=[], total_players=0)
-
-        print(f"Fetched {len(stats_response.data)} raw player stats entries for exchange {exchange}")
-
-        # Step 2: Extract user IDs and fetch profiles
-        player_ids = list(set(stat["player_id"] for stat in stats_response.data))
-        profiles_data = {}
-        if player_ids:
-            profiles_query = (
-                supabase.table("profiles")
-                .select("id, username") # Assuming profile table has user_id PK/FK
-                .in_("id", player_ids)
-            )
-            profiles_response: PostgrestAPIResponse = profiles_query.execute()
-
-            if profiles_response.data is None:
-                print(f"Warning: Failed to fetch profiles for users. Response: {profiles_response}")
-                # Continue without usernames if profiles fetch fails
-            elif profiles_response.data:
-                 profiles_data = {profile["id"]: profile["username"] for profile in profiles_response.data}
-                 print(f"Fetched {len(profiles_data)} profiles for {len(player_ids)} unique users")
-
-
-        # Step 3: Calculate metrics and prepare for sorting
-        processed_players = []
-        for player_stat in stats_response.data:
-            player_id_val = player_stat.get("player_id")
-            username = profiles_data.get(player_id_val, "Unknown User") # Get username from map
-
-            games_played_val = player_stat.get("games_played", 0)
-            correct_predictions = player_stat.get("total_correct", 0)
-            total_time_ms = player_stat.get("total_time_milliseconds", 0)
-            streak = player_stat.get("current_streak", 0)
-            total_raw_score = player_stat.get("total_score", 0)
-
-            # Calculate accuracy
-            accuracy = (correct_predictions / games_played_val) * 100 if games_played_val > 0 else 0.0
-
-            # Calculate average speed for correct answers in milliseconds
-            avg_speed = (total_time_ms / correct_predictions) if correct_predictions > 0 else None # Keep as None if no correct answers
-
-             # Calculate average score (optional, based on raw score from calculate_game_score)
-            avg_score_calculated = (total_raw_score / games_played_val) if games_played_val > 0 else 0.0
-
-            processed_players.append({
-                "player_id": player_id_val,
-                "username": username,
-                "accuracy_percent": accuracy,
-                "games_played": games_played_val,
-                "avg_speed_ms": avg_speed,
-                "avg_score": avg_score_calculated,
-                "current_streak": streak,
-            })
-
-        # Step 4: Sort the processed data in Python
-        # Primary: accuracy_percent DESC
-        # Secondary: avg_speed_ms ASC (treat None as infinitely slow, place them last in ascending sort)
-        # Tertiary: current_streak DESC
-        def sort_key(player):
-            # For avg_speed_ms, use infinity if None or 0, ensuring they rank lower in ascending sort
-            speed = player["avg_speed_ms"]
-            sortable_speed = speed if speed is not None and speed > 0 else float('inf')
-            # Return tuple for multi-level sorting
-            return (-player["accuracy_percent"], sortable_speed, -player["current_streak"])
-
-        processed_players.sort(key=sort_key)
-
-        # Step 5: Apply pagination and assign ranks
-        total_players_count = len(processed_players)
-        paginated_players = processed_players[offset : offset + limit]
-
-        leaderboard_entries = []
-        for i, player in enumerate(paginated_players):
-            rank = offset + i + 1
-            leaderboard_entries.append(
-                LeaderboardEntry(
-                    rank=rank,
-                    player_id=player["player_id"],
-                    username=player["username"],
-                    accuracy_percent=round(player["accuracy_percent"], 2), # Round for display
-                    games_played=player["games_played"],
-                    # Round speed for display, handle None
-                    avg_speed_ms=round(player["avg_speed_ms"]) if player["avg_speed_ms"] is not None else None,
-                    # Round avg score for display
-                    avg_score=round(player["avg_score"], 2) if player["avg_score"] is not None else None,
-                )
-            )
-
-        print(f"Returning {len(leaderboard_entries)} leaderboard entries for exchange {exchange}. Total eligible players: {total_players_count}")
-
-        return LeaderboardResponse(
-            leaderboard=leaderboard_entries,
-            total_players=total_players_count
-        )
-
+        stats_response: PostgrestAPIResponse = supabase.rpc(
+            "get_leaderboard",
+            {"exchange": exchange, "lim": limit, "off": offset}
+        ).execute()
     except Exception as e:
         print(f"Error in get_leaderboard for exchange {exchange}: {e}")
+        with _leaderboard_cache_lock:
+            stale_page = _stale_leaderboard_cache.get(cache_key)
+        if stale_page is not None:
+            print(f"Serving stale leaderboard for exchange {exchange}, limit: {limit}, offset: {offset}")
+            return _json_response(request, stale_page, headers={"X-Cache": "stale"})
         # Check if it's a Supabase/PostgREST error specifically
         if hasattr(e, 'message'):
              error_detail = e.message
         else:
              error_detail = str(e)
         raise HTTPException(status_code=500, detail=f"An error occurred while fetching the leaderboard: {error_detail}")
+
+    # The total comes from the windowed count on the first row. A page past the
+    # end holds a single row with a NULL rank that only carries the total.
+    # Rows are unpacked lazily into LeaderboardRow and turned into entries in one
+    # pass, so only the `limit` entries of the page are materialized.
+    rows = stats_response.data or []
+    total_players_count = rows[0]["total_players"] if rows else 0
+    players = (LeaderboardRow(**row) for row in rows)
+
+    # Step 2: Build entries (rows are already ranked and ordered by Postgres)
+    # Values come typed and already rounded for display from the RPC, so
+    # model_construct skips re-validating them.
+    leaderboard_entries = [
+        LeaderboardEntry.model_construct(
+            rank=player.rank,
+            player_id=player.player_id,
+            username=player.username,
+            accuracy_percent=player.accuracy_percent,
+            games_played=player.games_played,
+            avg_speed_ms=player.avg_speed_ms,
+            avg_score=player.avg_score,
+        )
+        for player in players
+        if player.rank is not None
+    ]
+
+    if not leaderboard_entries:
+         print(f"No player stats found for exchange {exchange} at offset {offset}. Total eligible players: {total_players_count}")
+
+    print(f"Returning {len(leaderboard_entries)} leaderboard entries for exchange {exchange}. Total eligible players: {total_players_count}")
+
+    leaderboard_response = LeaderboardResponse(
+        leaderboard=leaderboard_entries,
+        total_players=total_players_count
+    )
+    return _json_response(request, _cache_leaderboard(cache_key, leaderboard_response))
@@ -4,10 +4,11 @@ This module contains documentation for migrations, including SQL commands
 that need to be run in the Supabase SQL editor before the migration.
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 import databutton as db
+from cachetools import TTLCache
 
 from app.apis.auth_utils import require_permission
 from app.apis.admin_permissions import Permissions
@@ -62,12 +63,741 @@ CREATE POLICY scheduler_errors_admin_policy ON scheduler_errors
     USING (auth.jwt() ->> 'role' = 'admin');
 """
 
+# SQL function backing GET /leaderboard/{exchange}. Ranking, pagination and the
+# eligible-player count are computed in Postgres so the API only receives one page.
+LEADERBOARD_SQL = """
+-- Store accuracy so the leaderboard sort key can be indexed
+ALTER TABLE player_exchange_stats
+    ADD COLUMN IF NOT EXISTS accuracy_percent double precision
+    GENERATED ALWAYS AS ((total_correct::float / NULLIF(games_played, 0)) * 100) STORED;
+
+-- Covering index matching the leaderboard ordering (index-only scan per exchange).
+-- CONCURRENTLY cannot run inside a transaction block: run this statement on its own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS player_exchange_stats_leaderboard_idx
+    ON player_exchange_stats (exchange_code, accuracy_percent DESC, current_streak DESC)
+    INCLUDE (total_time_milliseconds, total_correct, total_score, player_id)
+    WHERE games_played > 0;
+
+-- Precomputed, ranked leaderboard for every exchange.
+-- Refreshed whenever player_exchange_stats is written (see trigger below), so
+-- reads never recompute metrics or ranks. Tied players share a rank.
+DROP FUNCTION IF EXISTS get_leaderboard(text, int, int);
+CREATE MATERIALIZED VIEW IF NOT EXISTS leaderboard_mv AS
+    WITH eligible AS (
+        SELECT
+            s.exchange_code,
+            s.player_id::uuid AS player_id,
+            COALESCE(p.username, 'Unknown User')::text AS username,
+            s.games_played::integer AS games_played,
+            s.accuracy_percent,
+            s.total_time_milliseconds::float / NULLIF(s.total_correct, 0) AS avg_speed_ms,
+            s.total_score::float / NULLIF(s.games_played, 0) AS avg_score,
+            s.current_streak::integer AS current_streak
+        FROM player_exchange_stats s
+        LEFT JOIN profiles p ON p.id = s.player_id::uuid
+        WHERE s.games_played > 0
+    )
+    SELECT
+        -- A zero average speed means no timing data, so it ranks with the NULLs
+        RANK() OVER (
+            PARTITION BY e.exchange_code
+            ORDER BY e.accuracy_percent DESC, NULLIF(e.avg_speed_ms, 0) ASC NULLS LAST, e.current_streak DESC
+        ) AS rank,
+        e.*,
+        COUNT(*) OVER (PARTITION BY e.exchange_code) AS total_players
+    FROM eligible e;
+
+-- REFRESH ... CONCURRENTLY needs a unique index; (exchange_code, rank) is not
+-- unique because tied players share a rank.
+CREATE UNIQUE INDEX IF NOT EXISTS leaderboard_mv_player_idx ON leaderboard_mv (exchange_code, player_id);
+DROP INDEX IF EXISTS leaderboard_mv_rank_idx;
+CREATE INDEX IF NOT EXISTS leaderboard_mv_rank_player_idx ON leaderboard_mv (exchange_code, rank, player_id);
+
+-- Materialized views cannot have RLS, so keep the view away from PostgREST clients;
+-- the API reads it through get_leaderboard with the service role
+REVOKE ALL ON leaderboard_mv FROM anon, authenticated;
+
+-- Refresh once per statement: the stats upsert writes every player in one statement.
+-- REFRESH MATERIALIZED VIEW needs the view's owner, hence SECURITY DEFINER; trigger
+-- functions are never callable through /rpc, but EXECUTE is revoked all the same.
+CREATE OR REPLACE FUNCTION refresh_leaderboard_mv()
+RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER
+AS $$
+BEGIN
+    REFRESH MATERIALIZED VIEW CONCURRENTLY leaderboard_mv;
+    RETURN NULL;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION refresh_leaderboard_mv() FROM PUBLIC, anon, authenticated;
+
+DROP TRIGGER IF EXISTS player_exchange_stats_refresh_leaderboard ON player_exchange_stats;
+CREATE TRIGGER player_exchange_stats_refresh_leaderboard
+    AFTER INSERT OR UPDATE OR DELETE ON player_exchange_stats
+    FOR EACH STATEMENT EXECUTE FUNCTION refresh_leaderboard_mv();
+
+-- Leaderboard page for a single exchange: an index range scan of leaderboard_mv.
+-- Only the columns the API returns are projected (streak is a tie-breaker only).
+-- Pages are row positions in (rank, player_id) order, so tied players are split
+-- across pages without being skipped and a page never holds more than `lim` rows;
+-- rank is only the displayed value. total_players comes from the windowed count
+-- stored in the view; a page past the end returns one row with a NULL rank that only
+-- carries total_players. Metrics are rounded here for display (ranking in the
+-- view uses the unrounded values), so the API never rounds them itself.
+CREATE OR REPLACE FUNCTION get_leaderboard(exchange text, lim int, off int)
+RETURNS TABLE (
+    rank bigint,
+    player_id uuid,
+    username text,
+    games_played integer,
+    accuracy_percent numeric,
+    avg_speed_ms numeric,
+    avg_score numeric,
+    total_players bigint
+)
+LANGUAGE sql STABLE
+AS $$
+    WITH page AS (
+        SELECT
+            m.rank, m.player_id, m.username, m.games_played,
+            ROUND(m.accuracy_percent::numeric, 2) AS accuracy_percent,
+            ROUND(m.avg_speed_ms::numeric) AS avg_speed_ms,
+            ROUND(m.avg_score::numeric, 2) AS avg_score,
+            m.total_players
+        FROM leaderboard_mv m
+        WHERE m.exchange_code = get_leaderboard.exchange
+        ORDER BY m.rank, m.player_id
+        LIMIT lim OFFSET off
+    )
+    SELECT * FROM (
+        SELECT * FROM page
+        UNION ALL
+        (
+            SELECT NULL, NULL, NULL, NULL, NULL, NULL, NULL, m.total_players
+            FROM leaderboard_mv m
+            WHERE m.exchange_code = get_leaderboard.exchange
+              AND NOT EXISTS (SELECT 1 FROM page)
+            LIMIT 1
+        )
+    ) rows
+    ORDER BY rows.rank NULLS LAST, rows.player_id;
+$$;
+
+-- Last game date folded into each player's stats, so per-game deltas are applied once
+ALTER TABLE player_exchange_stats ADD COLUMN IF NOT EXISTS last_game_date date;
+
+-- Recompute player_exchange_stats for one exchange from every scored prediction
+-- (is_correct set by process_pair_results) on its games up to p_max_date, in a single
+-- upsert statement (a full rebuild). Predictions not scored yet are left out; those on
+-- games whose result is a TIE/ERROR count as played but are not scored and do not
+-- break streaks. Correct picks score 100 plus up to 50 for speed
+-- (0 s = 50, 60 s+ = 0), incorrect picks score 25. Streaks are runs of correct
+-- picks found with the gaps-and-islands row-number difference.
+-- Returns the number of players upserted.
+CREATE OR REPLACE FUNCTION refresh_player_exchange_stats(p_exchange text, p_max_date date)
+RETURNS integer
+LANGUAGE plpgsql
+AS $fn$
+DECLARE
+    upserted integer;
+BEGIN
+    EXECUTE format($sql$
+        WITH scored AS (
+            SELECT
+                p.user_id,
+                g.game_date,
+                CASE
+                    WHEN g.actual_winner_ticker IN ('TIE', 'ERROR') THEN NULL
+                    WHEN p.is_correct THEN 1
+                    ELSE 0
+                END AS correct,
+                p.time_taken_secs
+            FROM predictions p
+            JOIN %I g ON g.id = p.pair_id
+            WHERE g.game_date <= $1
+              AND p.is_correct IS NOT NULL
+        ),
+        islands AS (
+            SELECT
+                s.user_id,
+                s.game_date,
+                s.correct,
+                ROW_NUMBER() OVER (PARTITION BY s.user_id ORDER BY s.game_date)
+                    - ROW_NUMBER() OVER (PARTITION BY s.user_id, s.correct ORDER BY s.game_date) AS island
+            FROM scored s
+            WHERE s.correct IS NOT NULL
+        ),
+        runs AS (
+            SELECT user_id, COUNT(*) AS run_length, MAX(game_date) AS run_end
+            FROM islands
+            WHERE correct = 1
+            GROUP BY user_id, island
+        ),
+        streaks AS (
+            -- The current streak is the run that ends on the player's last scored game
+            SELECT
+                r.user_id,
+                MAX(r.run_length) AS longest_streak,
+                COALESCE(MAX(r.run_length) FILTER (WHERE r.run_end = l.last_scored), 0) AS current_streak
+            FROM runs r
+            JOIN (SELECT user_id, MAX(game_date) AS last_scored FROM islands GROUP BY user_id) l USING (user_id)
+            GROUP BY r.user_id
+        ),
+        totals AS (
+            SELECT
+                user_id,
+                COUNT(*) AS games_played,
+                COUNT(*) FILTER (WHERE correct = 1) AS total_correct,
+                COALESCE(SUM(time_taken_secs * 1000) FILTER (WHERE correct = 1 AND time_taken_secs > 0), 0) AS total_time_milliseconds,
+                COALESCE(SUM(
+                    CASE
+                        WHEN correct = 1 AND time_taken_secs > 0 THEN 100 + GREATEST(0, 50 - LEAST(50, time_taken_secs / 1.2))
+                        WHEN correct = 1 THEN 100
+                        WHEN correct = 0 THEN 25
+                        ELSE 0
+                    END
+                ), 0) AS total_score
+            FROM scored
+            GROUP BY user_id
+        )
+        INSERT INTO player_exchange_stats (
+            player_id, exchange_code, games_played, total_correct, current_streak,
+            longest_streak, total_time_milliseconds, total_score, last_game_date, last_updated
+        )
+        SELECT
+            t.user_id, %L, t.games_played, t.total_correct, COALESCE(s.current_streak, 0),
+            COALESCE(s.longest_streak, 0), t.total_time_milliseconds, t.total_score, $1, now()
+        FROM totals t
+        LEFT JOIN streaks s USING (user_id)
+        ON CONFLICT (player_id, exchange_code) DO UPDATE SET
+            games_played = EXCLUDED.games_played,
+            total_correct = EXCLUDED.total_correct,
+            current_streak = EXCLUDED.current_streak,
+            longest_streak = EXCLUDED.longest_streak,
+            total_time_milliseconds = EXCLUDED.total_time_milliseconds,
+            total_score = EXCLUDED.total_score,
+            last_game_date = EXCLUDED.last_game_date,
+            last_updated = EXCLUDED.last_updated
+    $sql$, lower(p_exchange) || '_games', upper(p_exchange))
+    USING p_max_date;
+
+    GET DIAGNOSTICS upserted = ROW_COUNT;
+    RETURN upserted;
+END;
+$fn$;
+
+-- Only the backend (service role) may rebuild stats; Supabase grants EXECUTE on new
+-- functions to anon and authenticated by default
+REVOKE EXECUTE ON FUNCTION refresh_player_exchange_stats(text, date) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION refresh_player_exchange_stats(text, date) TO service_role;
+
+-- Fold a single processed game day into player_exchange_stats: only that day's
+-- predictions are aggregated and added to the stored totals, with the same scoring
+-- as the full rebuild. A player predicts each game once, so a day extends the
+-- streak (correct), resets it (incorrect, the only case scoring exactly 25 with no
+-- correct pick) or leaves it alone (TIE or ERROR). Days on or before a player's
+-- last_game_date are skipped, so re-running a day is harmless.
+-- A day with predictions not scored yet is left alone (it is folded in when its result
+-- is processed), and a day older than the latest one already folded in falls back to
+-- refresh_player_exchange_stats, since deltas can only be appended in date order.
+-- Returns the number of players updated or inserted.
+CREATE OR REPLACE FUNCTION apply_player_exchange_stats_delta(p_exchange text, p_game_date date)
+RETURNS integer
+LANGUAGE plpgsql
+AS $fn$
+DECLARE
+    upserted integer;
+    has_unscored boolean;
+    latest_game_date date;
+BEGIN
+    EXECUTE format($sql$
+        SELECT EXISTS (
+            SELECT 1
+            FROM predictions p
+            JOIN %I g ON g.id = p.pair_id
+            WHERE g.game_date = $1
+              AND p.is_correct IS NULL
+        )
+    $sql$, lower(p_exchange) || '_games')
+    INTO has_unscored
+    USING p_game_date;
+
+    IF has_unscored THEN
+        RETURN 0;
+    END IF;
+
+    SELECT MAX(last_game_date) INTO latest_game_date
+    FROM player_exchange_stats
+    WHERE exchange_code = upper(p_exchange);
+
+    IF latest_game_date > p_game_date THEN
+        RETURN refresh_player_exchange_stats(p_exchange, latest_game_date);
+    END IF;
+
+    EXECUTE format($sql$
+        WITH scored AS (
+            SELECT
+                p.user_id,
+                CASE
+                    WHEN g.actual_winner_ticker IN ('TIE', 'ERROR') THEN NULL
+                    WHEN p.is_correct THEN 1
+                    ELSE 0
+                END AS correct,
+                p.time_taken_secs
+            FROM predictions p
+            JOIN %I g ON g.id = p.pair_id
+            WHERE g.game_date = $1
+        ),
+        delta AS (
+            SELECT
+                user_id,
+                COUNT(*) AS games_played,
+                COUNT(*) FILTER (WHERE correct = 1) AS total_correct,
+                COALESCE(SUM(time_taken_secs * 1000) FILTER (WHERE correct = 1 AND time_taken_secs > 0), 0) AS total_time_milliseconds,
+                COALESCE(SUM(
+                    CASE
+                        WHEN correct = 1 AND time_taken_secs > 0 THEN 100 + GREATEST(0, 50 - LEAST(50, time_taken_secs / 1.2))
+                        WHEN correct = 1 THEN 100
+                        WHEN correct = 0 THEN 25
+                        ELSE 0
+                    END
+                ), 0) AS total_score
+            FROM scored
+            GROUP BY user_id
+        )
+        INSERT INTO player_exchange_stats AS s (
+            player_id, exchange_code, games_played, total_correct, current_streak,
+            longest_streak, total_time_milliseconds, total_score, last_game_date, last_updated
+        )
+        SELECT
+            d.user_id, %L, d.games_played, d.total_correct, d.total_correct,
+            d.total_correct, d.total_time_milliseconds, d.total_score, $1, now()
+        FROM delta d
+        ON CONFLICT (player_id, exchange_code) DO UPDATE SET
+            games_played = s.games_played + EXCLUDED.games_played,
+            total_correct = s.total_correct + EXCLUDED.total_correct,
+            current_streak = CASE
+                WHEN EXCLUDED.total_correct > 0 THEN s.current_streak + EXCLUDED.total_correct
+                WHEN EXCLUDED.total_score > 0 THEN 0
+                ELSE s.current_streak
+            END,
+            longest_streak = GREATEST(s.longest_streak, CASE
+                WHEN EXCLUDED.total_correct > 0 THEN s.current_streak + EXCLUDED.total_correct
+                ELSE 0
+            END),
+            total_time_milliseconds = s.total_time_milliseconds + EXCLUDED.total_time_milliseconds,
+            total_score = s.total_score + EXCLUDED.total_score,
+            last_game_date = EXCLUDED.last_game_date,
+            last_updated = EXCLUDED.last_updated
+        WHERE s.last_game_date IS NULL OR s.last_game_date < EXCLUDED.last_game_date
+    $sql$, lower(p_exchange) || '_games', upper(p_exchange))
+    USING p_game_date;
+
+    GET DIAGNOSTICS upserted = ROW_COUNT;
+    RETURN upserted;
+END;
+$fn$;
+
+-- Service role only, like refresh_player_exchange_stats
+REVOKE EXECUTE ON FUNCTION apply_player_exchange_stats_delta(text, date) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION apply_player_exchange_stats_delta(text, date) TO service_role;
+"""
+
+# SQL functions backing the MunyIQ endpoints. Only each user's latest score counts
+# towards the global statistics, so that reduction happens in Postgres.
+MUNYIQ_SQL = """
+-- Latest-score lookups per user (DISTINCT ON below, previous score and history in
+-- insert_munyiq_score, the user's score in the stats endpoint). Covering munyiq_score
+-- makes all of them index-only scans.
+-- CONCURRENTLY cannot run inside a transaction block: run this statement on its own.
+DROP INDEX IF EXISTS munyiq_scores_user_date_idx;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS munyiq_scores_user_date_score_idx
+    ON munyiq_scores (user_id, calculation_date DESC) INCLUDE (munyiq_score);
+
+-- One row per user: their most recent MunyIQ score
+CREATE OR REPLACE FUNCTION munyiq_latest_scores()
+RETURNS TABLE (user_id uuid, munyiq_score integer)
+LANGUAGE sql STABLE
+AS $$
+    SELECT DISTINCT ON (s.user_id) s.user_id::uuid, s.munyiq_score::integer
+    FROM munyiq_scores s
+    ORDER BY s.user_id, s.calculation_date DESC;
+$$;
+
+-- Cross-user MunyIQ statistics over each user's latest score, kept in a single row
+-- so the stats endpoint never aggregates on read. sorted_scores lets the API
+-- compute a user's percentile rank with a binary search.
+DROP FUNCTION IF EXISTS munyiq_stats(uuid);
+CREATE TABLE IF NOT EXISTS munyiq_latest_stats (
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    average_score numeric,
+    median_score double precision,
+    total_users_with_scores integer NOT NULL DEFAULT 0,
+    global_distribution jsonb NOT NULL DEFAULT '{}'::jsonb,
+    sorted_scores integer[] NOT NULL DEFAULT '{}',
+    last_updated timestamp with time zone DEFAULT now()
+);
+-- Written only by the trigger below and read by the backend (service role), which
+-- bypasses RLS; no policies, so anon and authenticated clients get nothing
+ALTER TABLE munyiq_latest_stats ENABLE ROW LEVEL SECURITY;
+REVOKE ALL ON munyiq_latest_stats FROM anon, authenticated;
+
+-- Every new score is its user's latest, so refresh once per statement. SECURITY
+-- DEFINER so the row is refreshed whichever role writes munyiq_scores; trigger
+-- functions are never callable through /rpc, but EXECUTE is revoked all the same.
+CREATE OR REPLACE FUNCTION refresh_munyiq_latest_stats()
+RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER
+AS $$
+BEGIN
+    INSERT INTO munyiq_latest_stats (
+        id, average_score, median_score, total_users_with_scores,
+        global_distribution, sorted_scores, last_updated
+    )
+    SELECT
+        1,
+        ROUND(AVG(l.munyiq_score), 1),
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY l.munyiq_score),
+        COUNT(*),
+        jsonb_build_object(
+            '0-50', COUNT(*) FILTER (WHERE l.munyiq_score <= 50),
+            '51-100', COUNT(*) FILTER (WHERE l.munyiq_score BETWEEN 51 AND 100),
+            '101-150', COUNT(*) FILTER (WHERE l.munyiq_score BETWEEN 101 AND 150),
+            '151-200', COUNT(*) FILTER (WHERE l.munyiq_score > 150)
+        ),
+        COALESCE(array_agg(l.munyiq_score ORDER BY l.munyiq_score), '{}'),
+        now()
+    FROM munyiq_latest_scores() l
+    ON CONFLICT (id) DO UPDATE SET
+        average_score = EXCLUDED.average_score,
+        median_score = EXCLUDED.median_score,
+        total_users_with_scores = EXCLUDED.total_users_with_scores,
+        global_distribution = EXCLUDED.global_distribution,
+        sorted_scores = EXCLUDED.sorted_scores,
+        last_updated = EXCLUDED.last_updated;
+    RETURN NULL;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION refresh_munyiq_latest_stats() FROM PUBLIC, anon, authenticated;
+
+DROP TRIGGER IF EXISTS munyiq_scores_refresh_latest_stats ON munyiq_scores;
+CREATE TRIGGER munyiq_scores_refresh_latest_stats
+    AFTER INSERT OR UPDATE OR DELETE ON munyiq_scores
+    FOR EACH STATEMENT EXECUTE FUNCTION refresh_munyiq_latest_stats();
+
+-- Populate the row for scores stored before the trigger existed (statement-level
+-- triggers fire even when no rows are touched)
+UPDATE munyiq_scores SET munyiq_score = munyiq_score WHERE false;
+
+-- Store a new MunyIQ score in one round trip: flags whether it beats the user's
+-- previous score and returns the 9 scores before it as history (newest first)
+CREATE OR REPLACE FUNCTION insert_munyiq_score(new_score jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    target_user uuid := (new_score ->> 'user_id')::uuid;
+    previous_score integer;
+    improved boolean;
+    history jsonb;
+BEGIN
+    -- The previous score is the newest history entry, so one read serves both
+    SELECT
+        COALESCE(
+            jsonb_agg(
+                jsonb_build_object('calculation_date', h.calculation_date, 'munyiq_score', h.munyiq_score)
+                ORDER BY h.calculation_date DESC
+            ),
+            '[]'::jsonb
+        ),
+        (array_agg(h.munyiq_score ORDER BY h.calculation_date DESC))[1]
+    INTO history, previous_score
+    FROM (
+        SELECT s.calculation_date, s.munyiq_score
+        FROM munyiq_scores s
+        WHERE s.user_id::uuid = target_user
+        ORDER BY s.calculation_date DESC
+        LIMIT 9
+    ) h;
+
+    improved := (new_score ->> 'munyiq_score')::integer > previous_score; -- NULL without a previous score
+
+    INSERT INTO munyiq_scores (
+        munyiq_id, user_id, munyiq_score, total_games, correct_games,
+        accuracy_score, consistency_score, speed_score, participation_score,
+        improvement_score, calculation_date, improved_since_last
+    )
+    SELECT
+        r.munyiq_id, r.user_id, r.munyiq_score, r.total_games, r.correct_games,
+        r.accuracy_score, r.consistency_score, r.speed_score, r.participation_score,
+        r.improvement_score, r.calculation_date, improved
+    FROM jsonb_populate_record(NULL::munyiq_scores, new_score) r;
+
+    RETURN jsonb_build_object('improved_since_last', improved, 'history', history);
+END;
+$$;
+
+-- Scores are stored by the backend only: anon and authenticated callers could
+-- otherwise insert scores for any user through /rpc
+REVOKE EXECUTE ON FUNCTION insert_munyiq_score(jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION insert_munyiq_score(jsonb) TO service_role;
+
+-- A user's predictions for a MunyIQ calculation
+CREATE INDEX IF NOT EXISTS predictions_user_pair_idx ON predictions (user_id, pair_id);
+
+-- Correctness of each of a user's predictions on processed games, in game date order
+CREATE OR REPLACE FUNCTION user_prediction_results(target_user uuid)
+RETURNS TABLE (is_correct boolean, submission_timestamp_utc timestamptz)
+LANGUAGE sql STABLE
+AS $$
+    SELECT
+        (p.predicted_ticker = r.actual_winner_ticker) AS is_correct,
+        p.submission_timestamp_utc::timestamptz
+    FROM predictions p
+    JOIN game_results r USING (pair_id)
+    WHERE p.user_id::uuid = target_user
+    ORDER BY r.game_date, p.submission_timestamp_utc;
+$$;
+
+-- Number of a user's predictions on processed games (cheap MunyIQ cache check)
+CREATE OR REPLACE FUNCTION user_prediction_results_count(target_user uuid)
+RETURNS bigint
+LANGUAGE sql STABLE
+AS $$
+    SELECT COUNT(*)
+    FROM predictions p
+    JOIN game_results r USING (pair_id)
+    WHERE p.user_id::uuid = target_user;
+$$;
+"""
+
+# SQL functions backing the predictions endpoints.
+PREDICTIONS_SQL = """
+-- One game per exchange and day. game_generation saves games with an upsert on
+-- (exchange, game_date), which needs this unique index. Duplicate days are removed
+-- first, keeping a game that has predictions; if two games for the same day both have
+-- predictions the index creation fails, and those must be merged by hand.
+DELETE FROM asx_games
+WHERE id IN (
+    SELECT ranked.id
+    FROM (
+        SELECT
+            g.id,
+            EXISTS (SELECT 1 FROM predictions p WHERE p.pair_id = g.id) AS has_predictions,
+            ROW_NUMBER() OVER (
+                PARTITION BY g.exchange, g.game_date
+                ORDER BY EXISTS (SELECT 1 FROM predictions p WHERE p.pair_id = g.id) DESC, g.id
+            ) AS rn
+        FROM asx_games g
+    ) ranked
+    WHERE ranked.rn > 1
+      AND NOT ranked.has_predictions
+);
+CREATE UNIQUE INDEX IF NOT EXISTS asx_games_exchange_game_date_key
+    ON asx_games (exchange, game_date);
+DELETE FROM nyse_games
+WHERE id IN (
+    SELECT ranked.id
+    FROM (
+        SELECT
+            g.id,
+            EXISTS (SELECT 1 FROM predictions p WHERE p.pair_id = g.id) AS has_predictions,
+            ROW_NUMBER() OVER (
+                PARTITION BY g.exchange, g.game_date
+                ORDER BY EXISTS (SELECT 1 FROM predictions p WHERE p.pair_id = g.id) DESC, g.id
+            ) AS rn
+        FROM nyse_games g
+    ) ranked
+    WHERE ranked.rn > 1
+      AND NOT ranked.has_predictions
+);
+CREATE UNIQUE INDEX IF NOT EXISTS nyse_games_exchange_game_date_key
+    ON nyse_games (exchange, game_date);
+
+-- Covering indexes for the daily game lookup and the player stats aggregation, so
+-- they are served by index-only scans instead of sequential scans.
+-- CONCURRENTLY cannot run inside a transaction block: run these statements on their own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS asx_games_date_status_idx
+    ON asx_games (game_date, status)
+    INCLUDE (id, exchange, company_a_ticker, company_a_name, company_b_ticker, company_b_name);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS predictions_pair_user_idx
+    ON predictions (pair_id, user_id)
+    INCLUDE (predicted_ticker, time_taken_secs);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS game_results_pair_winner_idx
+    ON game_results (pair_id)
+    INCLUDE (actual_winner_ticker);
+-- Unprocessed predictions only: stays small however large predictions grows, and
+-- serves the pair lookup in process_pair_results.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS predictions_pair_unprocessed_idx
+    ON predictions (pair_id)
+    WHERE is_correct IS NULL;
+
+-- Daily open/close prices used to decide game winners, so reprocessing a game does not
+-- call yfinance again
+CREATE TABLE IF NOT EXISTS ohlc_cache (
+    ticker text NOT NULL,
+    trade_date date NOT NULL,
+    open double precision NOT NULL,
+    close double precision NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (ticker, trade_date)
+);
+ALTER TABLE ohlc_cache ENABLE ROW LEVEL SECURITY;
+
+-- Records a processed game's result and scores its predictions in one round trip:
+-- sets the winner (and performances, when known) on the game row, then sets is_correct
+-- and time_taken_secs on every unprocessed prediction for the pair. A TIE counts as
+-- incorrect; time taken is seconds since p_game_start, floored at 0. NULL arguments
+-- leave the matching columns unchanged. Returns the number of predictions updated.
+DROP FUNCTION IF EXISTS update_predictions_bulk(uuid[], boolean[], double precision[]);
+CREATE OR REPLACE FUNCTION process_pair_results(
+    p_exchange text,
+    p_pair_id uuid,
+    p_winner text,
+    p_perf_a double precision,
+    p_perf_b double precision,
+    p_game_start timestamptz
+)
+RETURNS integer
+LANGUAGE plpgsql
+AS $fn$
+DECLARE
+    updated integer;
+BEGIN
+    IF p_winner IS NOT NULL THEN
+        EXECUTE format($sql$
+            UPDATE %I
+            SET
+                actual_winner_ticker = $2,
+                company_a_performance = COALESCE($3, company_a_performance),
+                company_b_performance = COALESCE($4, company_b_performance)
+            WHERE id = $1
+        $sql$, lower(p_exchange) || '_games')
+        USING p_pair_id, p_winner, p_perf_a, p_perf_b;
+    END IF;
+
+    IF p_winner IS NULL AND p_game_start IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    UPDATE predictions p
+    SET
+        is_correct = CASE
+            WHEN p_winner IS NULL THEN p.is_correct
+            WHEN p_winner = 'TIE' THEN false
+            ELSE p.predicted_ticker = p_winner
+        END,
+        time_taken_secs = CASE
+            WHEN p_game_start IS NULL OR p.submission_timestamp_utc IS NULL THEN p.time_taken_secs
+            ELSE GREATEST(0, EXTRACT(EPOCH FROM (p.submission_timestamp_utc - p_game_start)))
+        END
+    WHERE p.pair_id = p_pair_id
+      AND p.is_correct IS NULL;
+
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$fn$;
+
+-- The game to offer as today's prediction pair, in one round trip: today's scheduled
+-- game, else today's game in any status, else the most recent game. Each branch is an
+-- index lookup on asx_games_date_status_idx returning at most one row, tagged with its
+-- priority so the outer ORDER BY picks the winner deterministically.
+CREATE OR REPLACE FUNCTION get_best_daily_game(p_today date)
+RETURNS TABLE (
+    id uuid,
+    game_date date,
+    exchange text,
+    company_a_ticker text,
+    company_a_name text,
+    company_b_ticker text,
+    company_b_name text,
+    status text
+)
+LANGUAGE sql STABLE
+AS $$
+    SELECT
+        c.id, c.game_date, c.exchange, c.company_a_ticker,
+        c.company_a_name, c.company_b_ticker, c.company_b_name, c.status
+    FROM (
+        (
+            SELECT
+                1 AS priority,
+                g.id::uuid, g.game_date::date, g.exchange::text, g.company_a_ticker::text,
+                g.company_a_name::text, g.company_b_ticker::text, g.company_b_name::text, g.status::text
+            FROM asx_games g
+            WHERE g.game_date = p_today
+            ORDER BY (g.status IS NOT DISTINCT FROM 'scheduled') DESC
+            LIMIT 1
+        )
+        UNION ALL
+        (
+            SELECT
+                2 AS priority,
+                g.id::uuid, g.game_date::date, g.exchange::text, g.company_a_ticker::text,
+                g.company_a_name::text, g.company_b_ticker::text, g.company_b_name::text, g.status::text
+            FROM asx_games g
+            ORDER BY g.game_date DESC
+            LIMIT 1
+        )
+    ) c
+    ORDER BY c.priority
+    LIMIT 1;
+$$;
+"""
+
+# SQL function backing POST /results/process/{pair_id}.
+RESULTS_SQL = """
+-- Stores a processed pair's game result and its users' scores in one transaction.
+-- p_game is a game_results row and p_scores an array of user_scores rows (without
+-- result_id), both as JSON. If the pair already has a result it is kept as is and its
+-- result_id is reused; scores that already exist are skipped.
+-- Returns {"result_id": ..., "inserted_count": <new user_scores rows>}.
+CREATE OR REPLACE FUNCTION finalize_game_results(p_game jsonb, p_scores jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_result_id game_results.result_id%TYPE;
+    v_inserted integer := 0;
+BEGIN
+    INSERT INTO game_results (
+        pair_id, game_date, company_a_ticker, company_b_ticker, actual_winner_ticker,
+        actual_loser_ticker, company_a_change_percent, company_b_change_percent, calculation_details
+    )
+    SELECT
+        g.pair_id, g.game_date, g.company_a_ticker, g.company_b_ticker, g.actual_winner_ticker,
+        g.actual_loser_ticker, g.company_a_change_percent, g.company_b_change_percent, g.calculation_details
+    FROM jsonb_populate_record(NULL::game_results, p_game) g
+    -- No-op update so RETURNING also yields the existing row's id on a re-run
+    ON CONFLICT (pair_id) DO UPDATE SET pair_id = EXCLUDED.pair_id
+    RETURNING result_id INTO v_result_id;
+
+    IF jsonb_array_length(COALESCE(p_scores, '[]'::jsonb)) > 0 THEN
+        INSERT INTO user_scores (result_id, prediction_id, user_id, pair_id, is_correct)
+        SELECT v_result_id, s.prediction_id, s.user_id, s.pair_id, s.is_correct
+        FROM jsonb_populate_recordset(NULL::user_scores, p_scores) s
+        ON CONFLICT (prediction_id) DO NOTHING;
+        GET DIAGNOSTICS v_inserted = ROW_COUNT;
+    END IF;
+
+    RETURN jsonb_build_object('result_id', v_result_id, 'inserted_count', v_inserted);
+END;
+$$;
+"""
+
 class MigrationDocResponse(BaseModel):
     sql: str
     tables_exist: bool
     scheduler_migrated: bool
     cron_migrated: bool
     company_cache_sql: str
+    leaderboard_sql: str
+    munyiq_sql: str
+    predictions_sql: str
+    results_sql: str
     instructions: str
 
 # Constants - match those in scheduler and cron modules
@@ -79,55 +809,58 @@ def get_scheduler_migration_sql():
     """Returns the SQL commands needed to create scheduler tables in Supabase"""
     return SCHEDULER_TABLES_SQL
 
-def check_tables_exist() -> bool:
-    """Check if the required tables exist in Supabase"""
-    try:
-        supabase = get_supabase_admin_client()
-        # Try to query the scheduler_config table
-        response = supabase.table(SCHEDULER_CONFIG_TABLE).select("id").limit(1).execute()
-        # If we got here without exception, the table exists
-        return True
-    except Exception as e:
-        print(f"[INFO] Checking tables exist: {e}")
-        return False
+# Migration status only ever moves from False to True, so it is cached for a few
+# minutes and kept for good once every check has passed. A failed check (missing table,
+# network or auth error) is never cached, so it is retried on the next request.
+MIGRATION_STATUS_TTL_SECONDS = 300
+_migration_status_cache: TTLCache = TTLCache(maxsize=1, ttl=MIGRATION_STATUS_TTL_SECONDS)
+_migration_complete_status: Optional[Tuple[bool, bool, bool]] = None
 
-def check_scheduler_migrated() -> bool:
-    """Check if scheduler config has been migrated to Supabase"""
-    try:
-        supabase = get_supabase_admin_client()
-        response = supabase.table(SCHEDULER_CONFIG_TABLE) \
-            .select("value") \
-            .eq("key", MASTER_SCHEDULE_KEY) \
-            .limit(1) \
-            .execute()
-            
-        return len(response.data) > 0
-    except Exception as e:
-        print(f"[INFO] Checking scheduler migrated: {e}")
-        return False
+def get_cached_migration_status(refresh: bool = False) -> Tuple[bool, bool, bool]:
+    """Return the migration status, querying Supabase at most once per TTL unless refresh is set."""
+    global _migration_complete_status
+    if _migration_complete_status is not None:
+        return _migration_complete_status
+    
+    status = None if refresh else _migration_status_cache.get("status")
+    if status is None:
+        status = check_migration_status()
+        tables_exist = status[0] # False when the check query itself failed
+        if all(status):
+            _migration_complete_status = status
+        elif tables_exist:
+            _migration_status_cache["status"] = status
+        else:
+            _migration_status_cache.pop("status", None)
+    return status
 
-def check_cron_migrated() -> bool:
-    """Check if cron config has been migrated to Supabase"""
+def check_migration_status() -> Tuple[bool, bool, bool]:
+    """Check table existence and scheduler/cron migration in a single query.
+    
+    Returns:
+        (tables_exist, scheduler_migrated, cron_migrated)
+    """
     try:
         supabase = get_supabase_admin_client()
         response = supabase.table(SCHEDULER_CONFIG_TABLE) \
-            .select("value") \
-            .eq("key", CRON_CONFIG_KEY) \
-            .limit(1) \
+            .select("key") \
+            .in_("key", [MASTER_SCHEDULE_KEY, CRON_CONFIG_KEY]) \
             .execute()
-            
-        return len(response.data) > 0
+        # If we got here without exception, the table exists
+        keys = {row["key"] for row in response.data or []}
+        return True, MASTER_SCHEDULE_KEY in keys, CRON_CONFIG_KEY in keys
     except Exception as e:
-        print(f"[INFO] Checking cron migrated: {e}")
-        return False
+        print(f"[INFO] Checking migration status: {e}")
+        return False, False, False
 
 @router.get("/get-migration-docs", response_model=MigrationDocResponse)
-async def get_migration_docs(current_user_id: str = Depends(require_permission(Permissions.MANAGE_SYSTEM))):
+async def get_migration_docs(
+    refresh: bool = Query(False, description="Re-check migration status instead of using the cached result"),
+    current_user_id: str = Depends(require_permission(Permissions.MANAGE_SYSTEM))
+):
     """Get SQL and instructions for migrating scheduler and cron to Supabase"""
     try:
-        tables_exist = check_tables_exist()
-        scheduler_migrated = check_scheduler_migrated()
-        cron_migrated = check_cron_migrated()
+        tables_exist, scheduler_migrated, cron_migrated = get_cached_migration_status(refresh=refresh)
         
         instructions = """
 ## Migration Instructions:
@@ -141,6 +874,18 @@ Run the SQL in the `sql` field.
 #### Company Cache Tables
 Run the SQL in the `company_cache_sql` field.
 
+#### Leaderboard Functions
+Run the SQL in the `leaderboard_sql` field.
+
+#### MunyIQ Functions
+Run the SQL in the `munyiq_sql` field.
+
+#### Prediction Functions
+Run the SQL in the `predictions_sql` field.
+
+#### Results Functions
+Run the SQL in the `results_sql` field.
+
 ### Step 2: Migrate Data
 After creating tables, call these endpoints to migrate data:
 - POST /scheduler/migrate-to-supabase
@@ -149,6 +894,7 @@ After creating tables, call these endpoints to migrate data:
 
 ### Step 3: Verify Migration
 Refresh this page to verify migration status. All checks should show 'true'.
+A partial status is cached for up to 5 minutes; add `?refresh=true` to re-check immediately.
 """
         
         if tables_exist:
@@ -172,6 +918,10 @@ Refresh this page to verify migration status. All checks should show 'true'.
             scheduler_migrated=scheduler_migrated,
             cron_migrated=cron_migrated,
             company_cache_sql=COMPANY_CACHE_TABLES_SQL,
+            leaderboard_sql=LEADERBOARD_SQL,
+            munyiq_sql=MUNYIQ_SQL,
+            predictions_sql=PREDICTIONS_SQL,
+            results_sql=RESULTS_SQL,
             instructions=instructions
         )
     except Exception as e:
@@ -1,21 +1,34 @@
 from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Dict, Optional, Union, Any, Set
 from datetime import datetime, timezone, timedelta
-import statistics
+import numpy as np
 import uuid
 import math
-from app.apis.admin_permissions import Permissions
+import re
+from cachetools import TTLCache
+from app.apis.admin_permissions import Permissions, has_permission
 from app.apis.auth_utils import get_current_user, verify_premium_subscription, require_permission
 from app.apis.predictions_api import get_supabase_client
 import databutton as db
 
 # Initialize router
-router = APIRouter(prefix="/munyiq")
+router = APIRouter(prefix="/munyiq", default_response_class=ORJSONResponse)
 
 # Get Supabase client
 supabase = get_supabase_client()
 
+# Cross-user statistics change slowly, so the stats row is cached briefly and
+# dropped whenever a new score is stored.
+MUNYIQ_STATS_TTL_SECONDS = 120
+_munyiq_stats_cache: TTLCache = TTLCache(maxsize=1, ttl=MUNYIQ_STATS_TTL_SECONDS)
+
+# A calculated score is reused while the user's processed game count is unchanged,
+# keyed by (user_id, processed game count)
+MUNYIQ_SCORE_TTL_SECONDS = 24 * 60 * 60
+_munyiq_score_cache: TTLCache = TTLCache(maxsize=1024, ttl=MUNYIQ_SCORE_TTL_SECONDS)
+
 # --- Pydantic Models ---
 
 class MunyIQScoreDetail(BaseModel):
@@ -55,10 +68,16 @@ class MunyIQStatsResponse(BaseModel):
 
 # --- Helper Functions ---
 
+# Component weights, in order: accuracy, consistency, speed, participation, improvement
+MUNYIQ_WEIGHTS_WITH_IMPROVEMENT = np.array([0.40, 0.20, 0.20, 0.10, 0.10])
+# First calculation weights (redistribute improvement's 10%)
+MUNYIQ_WEIGHTS_FIRST = np.array([0.4444, 0.2222, 0.2222, 0.1111, 0.0])
+
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    import re
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
 
 def calculate_munyiq(stats: dict) -> dict:
     """
@@ -78,7 +97,7 @@ def calculate_munyiq(stats: dict) -> dict:
         stats: Dictionary containing the following keys:
             - correctGames: Number of correct predictions
             - totalGames: Total number of games played
-            - dailyScores: List of daily performance scores
+            - dailyScores: Array (or list) of daily performance scores
             - avgTimeTaken: Average time taken to make predictions (in seconds)
             - recentAccuracy: (optional) Recent accuracy rate
             - earlyAccuracy: (optional) Early accuracy rate
@@ -89,7 +108,7 @@ def calculate_munyiq(stats: dict) -> dict:
     # Extract values from stats
     correct_games = stats.get('correctGames', 0)
     total_games = stats.get('totalGames', 0)
-    daily_scores = stats.get('dailyScores', [])
+    daily_scores = np.asarray(stats.get('dailyScores', []), dtype=np.float64)
     avg_time_taken = stats.get('avgTimeTaken', 0)
     recent_accuracy = stats.get('recentAccuracy', 0)
     early_accuracy = stats.get('earlyAccuracy', 0)
@@ -99,75 +118,47 @@ def calculate_munyiq(stats: dict) -> dict:
     CONSISTENCY_PENALTY = 1.5  # Penalty factor for consistency calculation
     REFERENCE_GAMES = 100  # Reference for participation score (50% at 50 games)
     
-    # Initialize component scores
-    accuracy_score = consistency_score = speed_score = participation_score = improvement_score = 0
+    # Raw component values; every component is clipped to 0-100 in one step below
+    accuracy_score = improvement_score = 0
     
     # 1. Calculate Accuracy component (0-100)
     if total_games > 0:
         accuracy_score = (correct_games / total_games) * 100
     
     # 2. Calculate Consistency component (0-100)
-    if len(daily_scores) > 1:
-        try:
-            std_dev = statistics.stdev(daily_scores)
-            consistency_score = max(0, 100 - (std_dev * CONSISTENCY_PENALTY))
-        except statistics.StatisticsError:
-            # Handle case with insufficient data
-            consistency_score = 50  # Default middle value
+    if daily_scores.size > 1:
+        std_dev = float(daily_scores.std(ddof=1))  # Sample standard deviation
+        consistency_score = 100 - (std_dev * CONSISTENCY_PENALTY)
     else:
         consistency_score = 50  # Default value when not enough data
     
     # 3. Calculate Speed component (0-100)
     if avg_time_taken > 0:
         # Normalize: faster times = higher scores
-        speed_score = min(100, ((MAX_ALLOWED_TIME - avg_time_taken) / MAX_ALLOWED_TIME) * 100)
-        # Ensure non-negative
-        speed_score = max(0, speed_score)
+        speed_score = ((MAX_ALLOWED_TIME - avg_time_taken) / MAX_ALLOWED_TIME) * 100
     else:
         speed_score = 50  # Default middle value
     
     # 4. Calculate Participation component (0-50, scaled to 0-100 for weighting)
-    participation_raw = min(50, (total_games / REFERENCE_GAMES) * 50)
-    participation_score = participation_raw * 2  # Scale to 0-100 for consistent weighting
+    participation_score = (total_games / REFERENCE_GAMES) * 100
     
-    # Set weights based on total games
+    # Weights depend on whether the improvement factor applies
     has_improvement = total_games >= 40 and early_accuracy > 0 and recent_accuracy > 0
     
     if has_improvement:
         # 5. Calculate Improvement component (only when totalGames >= 40)
-        # Protect against division by zero
-        if early_accuracy > 0:
-            improvement_factor = ((recent_accuracy - early_accuracy) / early_accuracy) * 100
-            # Cap extreme values
-            improvement_score = max(0, min(100, improvement_factor))
-        else:
-            improvement_score = 0
-            
-        # Standard weights with improvement factor
-        w_accuracy = 0.40
-        w_consistency = 0.20
-        w_speed = 0.20
-        w_participation = 0.10
-        w_improvement = 0.10
-    else:
-        # First calculation weights (redistribute improvement's 10%)
-        w_accuracy = 0.4444
-        w_consistency = 0.2222
-        w_speed = 0.2222
-        w_participation = 0.1111
-        w_improvement = 0.0
+        improvement_score = ((recent_accuracy - early_accuracy) / early_accuracy) * 100
     
-    # Calculate raw score (0-100)
-    raw_score = (
-        accuracy_score * w_accuracy +
-        consistency_score * w_consistency +
-        speed_score * w_speed +
-        participation_score * w_participation
+    # Cap every component to 0-100, then weight them into the raw score (0-100);
+    # improvement_score stays 0 without the improvement factor
+    components = np.clip(
+        np.array([accuracy_score, consistency_score, speed_score, participation_score, improvement_score], dtype=np.float64),
+        0, 100
     )
-    
-    # Add improvement if applicable
-    if has_improvement:
-        raw_score += improvement_score * w_improvement
+    weights = MUNYIQ_WEIGHTS_WITH_IMPROVEMENT if has_improvement else MUNYIQ_WEIGHTS_FIRST
+    raw_score = float(components @ weights)
+    accuracy_score, consistency_score, speed_score, participation_score, improvement_score = components.tolist()
+    participation_raw = participation_score / 2  # Back to the 0-50 scale
     
     # Scale to 1-200 range and round to integer
     munyiq_score = round(raw_score * 2)
@@ -185,28 +176,53 @@ def calculate_munyiq(stats: dict) -> dict:
         "improvement_score": improvement_score if has_improvement else None
     }
 
+def _get_global_munyiq_stats() -> dict:
+    """
+    Return the cross-user MunyIQ statistics, reading them at most once per TTL.
+    
+    The munyiq_latest_stats table (see migration_docs MUNYIQ_SQL) is a single row
+    kept up to date by a trigger on munyiq_scores: average, median, user count,
+    distribution and every user's latest score in ascending order.
+    """
+    global_stats = _munyiq_stats_cache.get("stats")
+    if global_stats is None:
+        stats_response = supabase.table("munyiq_latest_stats").select(
+            "average_score, median_score, total_users_with_scores, global_distribution, sorted_scores"
+        ).limit(1).execute()
+        global_stats = stats_response.data[0] if stats_response.data else {}
+        # Running count of users at or below each score (index = score, 0-200), so a
+        # user's percentile is a single lookup
+        scores = np.asarray(global_stats.pop("sorted_scores", None) or [], dtype=np.int32)
+        global_stats["score_prefix"] = np.bincount(scores, minlength=201).cumsum()
+        _munyiq_stats_cache["stats"] = global_stats
+    return global_stats
+
 # --- API Endpoints ---
 
-@router.get("/score", response_model=MunyIQScoreResponse)
-async def get_munyiq_score(
+async def resolve_munyiq_target_user(
     user_id: Optional[str] = Query(None, description="User ID to get score for (admin only)"),
     current_user_id: str = Depends(verify_premium_subscription)
-):
+) -> str:
+    """FastAPI dependency resolving whose MunyIQ score is requested.
+    
+    Other users' scores require the MANAGE_USERS permission.
+    """
+    if not user_id or user_id == current_user_id:
+        return current_user_id
+    
+    if not has_permission(current_user_id, Permissions.MANAGE_USERS):
+        print(f"WARNING: User {current_user_id} lacks permission {Permissions.MANAGE_USERS} to view MunyIQ of {user_id}")
+        raise HTTPException(status_code=403, detail="Admin permission required to view other users' MunyIQ scores.")
+    
+    return user_id
+
+@router.get("/score", response_model=MunyIQScoreResponse)
+async def get_munyiq_score(target_user_id: str = Depends(resolve_munyiq_target_user)):
     """
     Get MunyIQ score for the authenticated user or a specific user (admin only).
     
     Premium subscription required.
     """
-    # Check if requesting another user's score (admin only)
-    target_user_id = current_user_id
-    if user_id and user_id != current_user_id:
-        # Verify admin permission if querying another user
-        try:
-            admin_user_id = Depends(require_permission(Permissions.MANAGE_USERS))
-            target_user_id = user_id
-        except HTTPException:
-            raise HTTPException(status_code=403, detail="Admin permission required to view other users' MunyIQ scores.")
-    
     try:
         # Check if user has a premium subscription
         user_response = supabase.table("profiles").select("subscription_tier, subscription_start_date").eq("id", target_user_id).single().execute()
@@ -215,57 +231,36 @@ async def get_munyiq_score(
         if not user_data or user_data.get("subscription_tier") not in ["premium", "pro"]:
             raise HTTPException(status_code=403, detail="Premium subscription required to access MunyIQ scores.")
         
-        # Get user's prediction history for calculation
-        prediction_response = supabase.table("predictions").select(
-            "prediction_id, pair_id, predicted_ticker, submission_timestamp_utc"
-        ).eq("user_id", target_user_id).execute()
-        
-        user_predictions = prediction_response.data or []
-        
-        if not user_predictions or len(user_predictions) < 20:
-            games_remaining = 20 - len(user_predictions)
-            return MunyIQScoreResponse(
-                current_score=None, 
-                previous_scores=[], 
-                subscribed_since=user_data.get("subscription_start_date", ""),
-                games_until_next_calculation=games_remaining
-            )
-        
-        # Get game results to determine correct predictions
-        # We need to join predictions with game_results to determine correct predictions
-        # This requires multiple queries or a more complex join
-        
-        # Get all game results for pairs the user has predicted
-        pair_ids = [pred["pair_id"] for pred in user_predictions]
-        results_response = supabase.table("game_results").select(
-            "pair_id, actual_winner_ticker"
-        ).in_("pair_id", pair_ids).execute()
-        
-        # Create a mapping of pair_id to winner_ticker
-        results_map = {result["pair_id"]: result["actual_winner_ticker"] for result in results_response.data or []}
+        # The score only changes when another of the user's games is resolved, so the
+        # last calculation is reused while the processed game count stays the same.
+        count_response = supabase.rpc(
+            "user_prediction_results_count", {"target_user": target_user_id}
+        ).execute()
+        score_cache_key = (target_user_id, count_response.data or 0)
+        cached_score = _munyiq_score_cache.get(score_cache_key)
+        if cached_score is not None:
+            return cached_score
+        
+        # Get the user's resolved predictions for calculation.
+        # The user_prediction_results SQL function (see migration_docs MUNYIQ_SQL) joins
+        # predictions with game_results in Postgres and returns, per processed game in
+        # game date order, whether the pick was correct and when it was submitted.
+        results_response = supabase.rpc(
+            "user_prediction_results", {"target_user": target_user_id}
+        ).execute()
+        prediction_results = results_response.data or []
         
         # Calculate correct games and time statistics
-        correct_games = 0
-        total_processed_games = 0
-        daily_scores = []
-        sum_time_taken = 0
-        submission_times = []
+        correct = np.array([result["is_correct"] for result in prediction_results], dtype=bool)
+        correct_games = int(correct.sum())
+        total_processed_games = len(prediction_results)
+        daily_scores = correct.astype(np.float64) * 100  # 100% for correct, 0% for incorrect
         
-        for pred in user_predictions:
-            pair_id = pred["pair_id"]
-            if pair_id in results_map:  # Only count games that have been processed
-                is_correct = pred["predicted_ticker"] == results_map[pair_id]
-                if is_correct:
-                    correct_games += 1
-                    daily_scores.append(100)  # 100% for correct
-                else:
-                    daily_scores.append(0)  # 0% for incorrect
-                
-                total_processed_games += 1
-                
-                # Get submission time if available (for speed calculation)
-                if pred.get("submission_timestamp_utc"):
-                    submission_times.append(pred["submission_timestamp_utc"])
+        # Get submission times if available (for speed calculation)
+        submission_times = [
+            result["submission_timestamp_utc"] for result in prediction_results
+            if result.get("submission_timestamp_utc")
+        ]
         
         # Calculate average time taken for predictions (mock data for now)
         # In a real implementation, we would calculate this from submission timestamps
@@ -286,13 +281,10 @@ async def get_munyiq_score(
         recent_accuracy = early_accuracy = None
         if total_processed_games >= 40:
             # Split the games into early games and recent games
-            # Get the first 20 and the most recent 20
-            # This is simplified - ideally we'd sort by date
-            early_games_correct = sum(1 for i, score in enumerate(daily_scores[:20]) if score == 100)
-            recent_games_correct = sum(1 for i, score in enumerate(daily_scores[-20:]) if score == 100)
-            
-            early_accuracy = early_games_correct / 20 * 100
-            recent_accuracy = recent_games_correct / 20 * 100
+            # Get the first 20 and the most recent 20 (results are in game date order)
+            # daily_scores holds 0/100 per game, so its mean is the accuracy percentage
+            early_accuracy = float(daily_scores[:20].mean())
+            recent_accuracy = float(daily_scores[-20:].mean())
         
         # Calculate MunyIQ score
         stats = {
@@ -308,17 +300,6 @@ async def get_munyiq_score(
         
         score_result = calculate_munyiq(stats)
         
-        # Check for existing score to determine if improved
-        current_score_response = supabase.table("munyiq_scores").select(
-            "*"
-        ).eq("user_id", target_user_id).order("calculation_date", desc=True).limit(1).execute()
-        
-        previous_score = None if not current_score_response.data else current_score_response.data[0]
-        improved_since_last = None
-        
-        if previous_score:
-            improved_since_last = score_result["munyiq_score"] > previous_score["munyiq_score"]
-        
         # Create new score entry
         munyiq_id = str(uuid.uuid4())
         now_utc = datetime.now(timezone.utc).isoformat()
@@ -334,25 +315,25 @@ async def get_munyiq_score(
             "speed_score": score_result["speed_score"],
             "participation_score": score_result["participation_score"],
             "improvement_score": score_result["improvement_score"],
-            "calculation_date": now_utc,
-            "improved_since_last": improved_since_last
+            "calculation_date": now_utc
         }
         
-        # Store the score in Supabase
-        supabase.table("munyiq_scores").insert(new_score).execute()
-        
-        # Get previous scores for history
-        history_response = supabase.table("munyiq_scores").select(
-            "munyiq_score, calculation_date"
-        ).eq("user_id", target_user_id).order("calculation_date", desc=True).limit(10).execute()
-        
-        history_entries = []
-        if history_response.data:
-            for entry in history_response.data[1:]:  # Skip the first one (current)
-                history_entries.append(MunyIQHistoryEntry(
-                    calculation_date=entry["calculation_date"],
-                    munyiq_score=entry["munyiq_score"]
-                ))
+        # Store the score in Supabase.
+        # The insert_munyiq_score SQL function (see migration_docs MUNYIQ_SQL) compares
+        # against the user's previous score, inserts the new row and returns the
+        # improvement flag with the previous scores for history in one round trip.
+        insert_response = supabase.rpc("insert_munyiq_score", {"new_score": new_score}).execute()
+        _munyiq_stats_cache.clear()
+        
+        insert_result = insert_response.data or {}
+        improved_since_last = insert_result.get("improved_since_last")
+        history_entries = [
+            MunyIQHistoryEntry(
+                calculation_date=entry["calculation_date"],
+                munyiq_score=entry["munyiq_score"]
+            )
+            for entry in insert_result.get("history") or []
+        ]
         
         # Create response
         score_detail = MunyIQScoreDetail(
@@ -370,12 +351,14 @@ async def get_munyiq_score(
             improved_since_last=improved_since_last
         )
         
-        return MunyIQScoreResponse(
+        score_response = MunyIQScoreResponse(
             current_score=score_detail,
             previous_scores=history_entries,
             subscribed_since=user_data.get("subscription_start_date", ""),
             games_until_next_calculation=None
         )
+        _munyiq_score_cache[score_cache_key] = score_response
+        return score_response
         
     except Exception as e:
         print(f"Error calculating MunyIQ score: {e}")
@@ -390,16 +373,10 @@ async def get_munyiq_stats(current_user_id: str = Depends(verify_premium_subscri
     Premium subscription required.
     """
     try:
-        # Get all MunyIQ scores (most recent for each user)
-        # This query assumes we're using a 'DISTINCT ON' PostgreSQL feature
-        # which may need to be adjusted depending on Supabase capabilities
+        global_stats = _get_global_munyiq_stats()
+        total_users = global_stats.get("total_users_with_scores") or 0
         
-        # Instead, we'll get all scores and filter in Python
-        scores_response = supabase.table("munyiq_scores").select(
-            "user_id, munyiq_score, calculation_date"
-        ).execute()
-        
-        if not scores_response.data:
+        if not total_users:
             return MunyIQStatsResponse(
                 average_score=0,
                 median_score=0,
@@ -408,69 +385,26 @@ async def get_munyiq_stats(current_user_id: str = Depends(verify_premium_subscri
                 global_distribution={}
             )
         
-        # Get most recent score for each user
-        user_latest_scores = {}
-        for score in scores_response.data:
-            user_id = score["user_id"]
-            calculation_date = score["calculation_date"]
-            
-            if user_id not in user_latest_scores or calculation_date > user_latest_scores[user_id]["calculation_date"]:
-                user_latest_scores[user_id] = score
+        # Get current user's latest score
+        user_score_response = supabase.table("munyiq_scores").select(
+            "munyiq_score"
+        ).eq("user_id", current_user_id).order("calculation_date", desc=True).limit(1).execute()
+        user_score = user_score_response.data[0]["munyiq_score"] if user_score_response.data else 0
         
-        # Extract scores only
-        all_scores = [score["munyiq_score"] for score in user_latest_scores.values()]
-        
-        if not all_scores:
-            return MunyIQStatsResponse(
-                average_score=0,
-                median_score=0,
-                percentile_rank=0,
-                total_users_with_scores=0,
-                global_distribution={}
-            )
-        
-        # Calculate current user's percentile
-        user_score = 0
-        for score in user_latest_scores.values():
-            if score["user_id"] == current_user_id:
-                user_score = score["munyiq_score"]
-                break
-        
-        # Calculate percentile rank
+        # Calculate percentile rank (share of users scoring at or below the user)
         if user_score > 0:
-            percentile_rank = sum(1 for score in all_scores if score <= user_score) / len(all_scores) * 100
+            score_prefix = global_stats["score_prefix"]
+            percentile_rank = int(score_prefix[min(user_score, 200)]) / int(score_prefix[-1]) * 100
             percentile_rank = round(percentile_rank)
         else:
             percentile_rank = 0
         
-        # Calculate average and median
-        average_score = sum(all_scores) / len(all_scores)
-        median_score = statistics.median(all_scores)
-        
-        # Calculate distribution
-        distribution = {
-            "0-50": 0,
-            "51-100": 0,
-            "101-150": 0,
-            "151-200": 0
-        }
-        
-        for score in all_scores:
-            if score <= 50:
-                distribution["0-50"] += 1
-            elif score <= 100:
-                distribution["51-100"] += 1
-            elif score <= 150:
-                distribution["101-150"] += 1
-            else:
-                distribution["151-200"] += 1
-        
         return MunyIQStatsResponse(
-            average_score=round(average_score, 1),
-            median_score=median_score,
+            average_score=global_stats["average_score"],
+            median_score=global_stats["median_score"],
             percentile_rank=percentile_rank,
-            total_users_with_scores=len(all_scores),
-            global_distribution=distribution
+            total_users_with_scores=total_users,
+            global_distribution=global_stats["global_distribution"]
         )
         
     except Exception as e:
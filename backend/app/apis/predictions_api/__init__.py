@@ -1,16 +1,20 @@
 # src/app/apis/predictions_api/__init__.py
 
-from fastapi import APIRouter, HTTPException, Depends, Header, Request # Add Request
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, BackgroundTasks # Add Request
 from supabase.lib.client_options import ClientOptions
 from gotrue.errors import AuthApiError
+from postgrest.types import ReturnMethod
 from pydantic import BaseModel, Field
-from datetime import date, datetime, timezone, timedelta, time # Ensure time is imported
+from datetime import date, datetime, timezone, timedelta
 import uuid
 import re
+import asyncio
+import threading
 from typing import Optional
+from cachetools import TTLCache, TLRUCache
 import yfinance as yf
 import pandas as pd
-import pytz
+import pandas_market_calendars as mcal
 import logging
 import os
 # import jwt # Removed jwt import
@@ -26,50 +30,61 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Supabase Client Initialization ---
+# Clients are created on first use rather than at import, so workers that never touch
+# one of them skip its secrets fetch and construction. A failed attempt is retried on
+# the next call.
 supabase_admin_client: Client | None = None
 supabase_anon_client: Client | None = None
-try:
-    supabase_url = db.secrets.get("SUPABASE_URL")
-    service_key = db.secrets.get("SUPABASE_SERVICE_ROLE_KEY")
-    anon_key = db.secrets.get("SUPABASE_ANON_KEY")
-
-    if not supabase_url: logger.error("SUPABASE_URL secret is missing!")
-    if not service_key: logger.error("SUPABASE_SERVICE_ROLE_KEY secret is missing!")
-    if not anon_key: logger.error("SUPABASE_ANON_KEY secret is missing!")
-
-    if supabase_url and service_key:
-        supabase_admin_client = create_client(supabase_url, service_key)
-        masked_key = f"{service_key[:4]}...{service_key[-4:]}" if service_key and len(service_key) > 8 else "[Key Invalid/Short]"
-        logger.info(f"Supabase ADMIN client created with URL: {supabase_url} and Service Key (masked): {masked_key}")
-    else:
-        supabase_admin_client = None
-        logger.error("Supabase ADMIN client set to None due to missing secrets.")
+_supabase_client_lock = threading.Lock()
 
-    if supabase_url and anon_key:
-        supabase_anon_client = create_client(supabase_url, anon_key)
-        logger.info("Supabase ANON client initialized successfully.")
-    else:
-        supabase_anon_client = None
-        logger.error("Supabase ANON client set to None due to missing secrets.")
+def get_supabase_admin_client() -> Client:
+    """Returns the Supabase ADMIN (service role) client, creating it on first use."""
+    global supabase_admin_client
+    if supabase_admin_client is not None:
+        return supabase_admin_client
+    with _supabase_client_lock:
+        if supabase_admin_client is None:
+            try:
+                supabase_url = db.secrets.get("SUPABASE_URL")
+                service_key = db.secrets.get("SUPABASE_SERVICE_ROLE_KEY")
 
-except Exception as e:
-    logger.exception(f"Failed to initialize Supabase clients: {e}")
-    supabase_admin_client = None
-    supabase_anon_client = None
+                if not supabase_url: logger.error("SUPABASE_URL secret is missing!")
+                if not service_key: logger.error("SUPABASE_SERVICE_ROLE_KEY secret is missing!")
 
-def get_supabase_admin_client() -> Client:
-    """Returns the initialized Supabase ADMIN (service role) client."""
-    if supabase_admin_client is None:
-        logger.critical("Attempted to use Supabase ADMIN client, but it's not initialized!")
-        raise HTTPException(status_code=503, detail="Database admin client is not initialized.")
-    return supabase_admin_client
+                if supabase_url and service_key:
+                    supabase_admin_client = create_client(supabase_url, service_key)
+                    masked_key = f"{service_key[:4]}...{service_key[-4:]}" if len(service_key) > 8 else "[Key Invalid/Short]"
+                    logger.info(f"Supabase ADMIN client created with URL: {supabase_url} and Service Key (masked): {masked_key}")
+            except Exception as e:
+                logger.exception(f"Failed to initialize Supabase ADMIN client: {e}")
+        if supabase_admin_client is None:
+            logger.critical("Attempted to use Supabase ADMIN client, but it's not initialized!")
+            raise HTTPException(status_code=503, detail="Database admin client is not initialized.")
+        return supabase_admin_client
 
 def get_supabase_anon_client() -> Client:
-    """Returns the initialized Supabase ANON client (respects RLS)."""
-    if supabase_anon_client is None:
-        logger.critical("Attempted to use Supabase ANON client, but it's not initialized!")
-        raise HTTPException(status_code=503, detail="Database anon client is not initialized.")
-    return supabase_anon_client
+    """Returns the Supabase ANON client (respects RLS), creating it on first use."""
+    global supabase_anon_client
+    if supabase_anon_client is not None:
+        return supabase_anon_client
+    with _supabase_client_lock:
+        if supabase_anon_client is None:
+            try:
+                supabase_url = db.secrets.get("SUPABASE_URL")
+                anon_key = db.secrets.get("SUPABASE_ANON_KEY")
+
+                if not supabase_url: logger.error("SUPABASE_URL secret is missing!")
+                if not anon_key: logger.error("SUPABASE_ANON_KEY secret is missing!")
+
+                if supabase_url and anon_key:
+                    supabase_anon_client = create_client(supabase_url, anon_key)
+                    logger.info("Supabase ANON client initialized successfully.")
+            except Exception as e:
+                logger.exception(f"Failed to initialize Supabase ANON client: {e}")
+        if supabase_anon_client is None:
+            logger.critical("Attempted to use Supabase ANON client, but it's not initialized!")
+            raise HTTPException(status_code=503, detail="Database anon client is not initialized.")
+        return supabase_anon_client
 
 def get_supabase_client() -> Client:
     """DEPRECATED? Returns the ADMIN (service role) client. Use get_supabase_admin_client() or get_supabase_anon_client() explicitly."""
@@ -85,178 +100,183 @@ def get_supabase_client() -> Client:
 router = APIRouter()
 
 # --- Helper functions ---
-async def _update_all_time_leaderboard(exchange: str, game_date: date):
+
+# Exchange trading calendars (holidays and session times), built once at import for the
+# results-processing path
+_MARKET_CALENDARS = {
+    "ASX": mcal.get_calendar("ASX"),
+    "NYSE": mcal.get_calendar("NYSE"),
+}
+
+# Yahoo can take a while after the close to publish the final daily bar, so a session
+# only counts as closed this long after its market close
+SESSION_SETTLE_DELAY = timedelta(hours=1)
+
+def _session_closed(exchange: str, day: date) -> bool:
+    """
+    Returns True once the exchange's trading session on the given day has closed (plus
+    SESSION_SETTLE_DELAY), so its daily prices are final. Days without a session count as
+    closed once they are over; exchanges without a calendar fall back to that rule too.
+    """
+    now_utc = datetime.now(timezone.utc)
+    market_calendar = _MARKET_CALENDARS.get(exchange)
+    if market_calendar is None:
+        return day < now_utc.date()
+    try:
+        sessions = market_calendar.schedule(start_date=day, end_date=day)
+    except Exception as e:
+        logger.warning(f"Could not read {exchange} trading calendar for {day}, treating session as open: {e}")
+        return False
+    if sessions.empty:
+        return day < now_utc.date()
+    market_close_utc = sessions['market_close'].iat[-1].to_pydatetime() # market_close is UTC
+    return now_utc >= market_close_utc + SESSION_SETTLE_DELAY
+
+# Daily prices are fixed once the session has closed, so they are kept for a few hours
+# to serve result retries and admin re-runs without refetching; prices for a session
+# that may still move are kept only briefly.
+YF_CLOSED_PRICE_CACHE_TTL_SECONDS = 6 * 60 * 60
+YF_OPEN_PRICE_CACHE_TTL_SECONDS = 5 * 60
+
+def _yf_price_cache_ttu(key, value, now):
+    _, _, session_closed = key
+    return now + (YF_CLOSED_PRICE_CACHE_TTL_SECONDS if session_closed else YF_OPEN_PRICE_CACHE_TTL_SECONDS)
+
+_yf_price_cache: TLRUCache = TLRUCache(maxsize=1024, ttu=_yf_price_cache_ttu)
+_yf_price_cache_lock = threading.Lock() # Fetches run in worker threads
+
+def _get_open_close(ticker: str, day: date, session_closed: bool) -> Optional[tuple[float, float]]:
+    """
+    Returns the (open, close) price of a ticker on the given day, or None if yfinance has
+    no data for it. Uses yf.Ticker().history, falling back to yf.download if that fails.
+    Results are cached per (ticker, day), for longer once the session has closed.
+    """
+    cache_key = (ticker, day.isoformat(), session_closed)
+    with _yf_price_cache_lock:
+        cached_prices = _yf_price_cache.get(cache_key)
+    if cached_prices is not None:
+        logger.info(f"Using cached yfinance prices for {ticker} on {day}")
+        return cached_prices
+
+    end = day + timedelta(days=1)
+    try:
+        data = yf.Ticker(ticker).history(start=day, end=end, interval="1d")
+    except Exception as e:
+        logger.warning(f"yfinance history failed for {ticker} on {day}, falling back to download: {e}")
+        data = yf.download(ticker, start=day, end=end, progress=False)
+        # Newer yfinance returns (field, ticker) columns even for one ticker
+        if isinstance(data.columns, pd.MultiIndex):
+            data.columns = data.columns.get_level_values(0)
+
+    # Missing data is usually transient (not published yet), so it is not cached
+    if data.empty or 'Open' not in data or 'Close' not in data:
+        return None
+    # .iat reads a single scalar without building an intermediate Series
+    prices = (float(data['Open'].iat[0]), float(data['Close'].iat[-1]))
+    with _yf_price_cache_lock:
+        _yf_price_cache[cache_key] = prices
+    return prices
+
+async def _get_pair_open_close(supabase_admin: Client, exchange: str, ticker_a: str, ticker_b: str, day: date) -> tuple[Optional[tuple[float, float]], Optional[tuple[float, float]]]:
+    """
+    Returns the (open, close) prices of both tickers on the given day. Prices are read
+    from the ohlc_cache table first (see migration_docs PREDICTIONS_SQL); only tickers
+    missing there are fetched from yfinance, concurrently, and then stored for next time
+    once the exchange's session has closed, so partial intraday prices are never stored.
+    """
+    day_str = day.isoformat()
+    stored: dict[str, tuple[float, float]] = {}
+    try:
+        cache_response = supabase_admin.table("ohlc_cache") \
+            .select("ticker, open, close") \
+            .in_("ticker", [ticker_a, ticker_b]) \
+            .eq("trade_date", day_str) \
+            .execute()
+        stored = {row["ticker"]: (row["open"], row["close"]) for row in cache_response.data or []}
+    except Exception as e:
+        logger.warning(f"Could not read ohlc_cache for {ticker_a}/{ticker_b} on {day}: {e}")
+
+    missing = [ticker for ticker in (ticker_a, ticker_b) if ticker not in stored]
+    if not missing:
+        logger.info(f"Using stored prices for {ticker_a} and {ticker_b} on {day}")
+        return stored[ticker_a], stored[ticker_b]
+
+    # yfinance lookups are blocking HTTP calls, so run them side by side off the event loop
+    session_closed = _session_closed(exchange, day)
+    fetched = await asyncio.gather(*(asyncio.to_thread(_get_open_close, ticker, day, session_closed) for ticker in missing))
+    new_rows = []
+    for ticker, prices in zip(missing, fetched):
+        if prices:
+            stored[ticker] = prices
+            new_rows.append({"ticker": ticker, "trade_date": day_str, "open": prices[0], "close": prices[1]})
+    if new_rows and not session_closed:
+        logger.info(f"{exchange} session on {day} has not closed yet, not storing prices in ohlc_cache")
+    elif new_rows:
+        try:
+            supabase_admin.table("ohlc_cache") \
+                .upsert(new_rows, on_conflict="ticker,trade_date", returning=ReturnMethod.minimal) \
+                .execute()
+        except Exception as e:
+            logger.warning(f"Could not store prices in ohlc_cache for {day}: {e}")
+
+    return stored.get(ticker_a), stored.get(ticker_b)
+
+async def _apply_leaderboard_delta(exchange: str, game_date: date):
     """
-    Updates player exchange stats for all players who submitted predictions for games on
-    the given exchange up to the specified date.
+    Folds the predictions for a single processed game day into player exchange stats.
     
-    This function:
-    1. Gets all processed predictions for the given exchange up to the specified date
-    2. For each player, calculates:
-       - Total games played
-       - Total correct predictions
-       - Current streak (consecutive correct predictions)
-       - Total time taken for submissions
-       - Total score (based on correctness and timing)
-    3. Updates the player_exchange_stats table with this data
+    Rather than rebuilding every player's stats from all history, this only aggregates
+    the given day's scored predictions and adds them to the stored totals and streaks,
+    via the apply_player_exchange_stats_delta SQL function (see migration_docs
+    LEADERBOARD_SQL). Days already folded in are skipped, days with unscored predictions
+    are left for a later run, and days older than the latest folded-in one trigger a
+    full rebuild in the database.
     
     Args:
         exchange: Exchange code (e.g., 'ASX', 'NYSE')
         game_date: The game date we just processed
     """
-    logger.info(f"Updating all-time leaderboard for {exchange} after processing game on {game_date}")
+    logger.info(f"Applying leaderboard delta for {exchange} game on {game_date}")
     
     try:
         supabase_admin = get_supabase_admin_client()
         
-        # 1. Get all game results for this exchange up to and including the processed date
-        game_table_name = f"{exchange.lower()}_games"
-        
-        # Get all processed games with their dates (up to our current game_date)
-        games_query = supabase_admin.table(game_table_name)\
-            .select("id, game_date")\
-            .lte("game_date", game_date.isoformat())\
-            .execute()
-            
-        if not games_query.data:
-            logger.warning(f"No games found for {exchange} up to {game_date}. Nothing to update.")
-            return
-            
-        # Get all pair_ids for these games to fetch results
-        pair_ids = [game["id"] for game in games_query.data]
-        pair_date_map = {game["id"]: game["game_date"] for game in games_query.data}
-        
-        # 2. Get all results for these games
-        results_query = supabase_admin.table("game_results")\
-            .select("pair_id, actual_winner_ticker")\
-            .in_("pair_id", pair_ids)\
-            .execute()
-            
-        if not results_query.data:
-            logger.warning(f"No results found for {exchange} games up to {game_date}. Nothing to update.")
-            return
-            
-        # Create mapping of pair_id to winner for easy lookup
-        results_map = {result["pair_id"]: result["actual_winner_ticker"] for result in results_query.data}
-        
-        # 3. Get all predictions for these games
-        predictions_query = supabase_admin.table("predictions")\
-            .select("prediction_id, pair_id, user_id, predicted_ticker, submission_timestamp_utc, time_taken_secs")\
-            .in_("pair_id", pair_ids)\
-            .execute()
-            
-        if not predictions_query.data:
-            logger.warning(f"No predictions found for {exchange} games up to {game_date}. Nothing to update.")
-            return
-            
-        # 4. Group predictions by user
-        user_predictions = {}
-        
-        for pred in predictions_query.data:
-            user_id = pred["user_id"]
-            if user_id not in user_predictions:
-                user_predictions[user_id] = []
-            user_predictions[user_id].append(pred)
-            
-        # 5. Calculate stats for each user
-        stats_to_update = []
+        stats_response = supabase_admin.rpc(
+            "apply_player_exchange_stats_delta",
+            {"p_exchange": exchange, "p_game_date": game_date.isoformat()}
+        ).execute()
         
-        for user_id, predictions in user_predictions.items():
-            # Sort predictions by date (using pair_id lookup to game_date)
-            # This is important for calculating streaks correctly
-            sorted_predictions = sorted(
-                predictions,
-                key=lambda p: pair_date_map.get(p["pair_id"], "")
-            )
-            
-            # Calculate stats
-            total_games = len(sorted_predictions)
-            correct_games = 0
-            current_streak = 0
-            longest_streak = 0
-            total_time_ms = 0
-            total_score = 0
-            
-            # Track consecutive correct predictions
-            temp_streak = 0
-            
-            for pred in sorted_predictions:
-                pair_id = pred["pair_id"]
-                if pair_id in results_map:
-                    predicted_ticker = pred["predicted_ticker"]
-                    actual_winner = results_map[pair_id]
-                    
-                    # Skip ties and errors
-                    if actual_winner in ["TIE", "ERROR"]:
-                        continue
-                    
-                    is_correct = predicted_ticker == actual_winner
-                    
-                    if is_correct:
-                        correct_games += 1
-                        temp_streak += 1
-                        
-                        # Add to score (base 100 for correct + speed bonus)
-                        time_taken_secs = pred.get("time_taken_secs", 0)
-                        time_taken_ms = time_taken_secs * 1000 if time_taken_secs else 0
-                        
-                        if time_taken_ms > 0:
-                            # Up to 50 bonus points based on speed (faster = more points)
-                            # Scale: 0 seconds = 50 points, 60+ seconds = 0 points
-                            time_bonus = max(0, 50 - min(50, time_taken_secs / 1.2))
-                            prediction_score = 100 + time_bonus
-                        else:
-                            prediction_score = 100
-                            
-                        total_score += prediction_score
-                    else:
-                        # Reset streak
-                        temp_streak = 0
-                        # Still give base score for participation
-                        total_score += 25
-                    
-                    # Track best streak
-                    longest_streak = max(longest_streak, temp_streak)
-                    
-                    # Add time taken if available
-                    if time_taken_secs:
-                        total_time_ms += time_taken_secs * 1000
-            
-            # Current streak is the most recent consecutive correct predictions
-            current_streak = temp_streak
-            
-            # 6. Create or update player_exchange_stats entry
-            stats_entry = {
-                "player_id": user_id,
-                "exchange_code": exchange.upper(),
-                "games_played": total_games,
-                "total_correct": correct_games,
-                "current_streak": current_streak,
-                "longest_streak": longest_streak,
-                "total_time_milliseconds": total_time_ms,
-                "total_score": total_score,
-                "last_updated": datetime.now(timezone.utc).isoformat()
-            }
-            
-            stats_to_update.append(stats_entry)
-            
-        # 7. Bulk upsert stats to player_exchange_stats table
-        if stats_to_update:
-            logger.info(f"Upserting {len(stats_to_update)} player stats entries for {exchange}")
-            
-            # Use upsert to handle both insert and update cases
-            stats_response = supabase_admin.table("player_exchange_stats")\
-                .upsert(stats_to_update, on_conflict="player_id,exchange_code")\
-                .execute()
-                
-            logger.info(f"Leaderboard update complete for {exchange}. Status: {getattr(stats_response, 'status_code', 'unknown')}")
+        if stats_response.data:
+            logger.info(f"Leaderboard delta applied for {exchange}. Updated {stats_response.data} player stats entries")
         else:
-            logger.warning(f"No player stats to update for {exchange}")
+            logger.warning(f"No player stats to update for {exchange} on {game_date}")
             
     except Exception as e:
-        logger.exception(f"Error updating all-time leaderboard for {exchange}: {e}")
+        logger.exception(f"Error applying leaderboard delta for {exchange}: {e}")
         raise
 
+# Leaderboard updates queued by process_game_results but not yet started. A trigger for
+# an (exchange, game_date) already in the set is dropped, so bursts coalesce into one run;
+# the lock runs updates one at a time so deltas are applied in order.
+_pending_leaderboard_updates: set[tuple[str, date]] = set()
+_leaderboard_update_lock = asyncio.Lock()
+
+async def _run_leaderboard_update(exchange: str, game_date: date):
+    """Background task: applies the leaderboard delta for a processed game, coalescing duplicate triggers."""
+    key = (exchange, game_date)
+    if key in _pending_leaderboard_updates:
+        logger.info(f"Leaderboard update for {exchange} on {game_date} already queued, skipping duplicate trigger")
+        return
+    _pending_leaderboard_updates.add(key)
+    try:
+        async with _leaderboard_update_lock:
+            _pending_leaderboard_updates.discard(key)
+            await _apply_leaderboard_delta(exchange, game_date)
+            logger.info(f"Leaderboard successfully updated for exchange {exchange}")
+    except Exception as le:
+        _pending_leaderboard_updates.discard(key)
+        logger.exception(f"Error updating leaderboard for {exchange}: {le}")
+
 # --- Pydantic Models ---
 class NextClueResponse(BaseModel):
     """Response model for the next game clue."""
@@ -316,13 +336,20 @@ class PredictionResponse(BaseModel): # Defined before use
 
 
 # --- Helper Functions ---
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
 
 
 # --- API Endpoints ---
 
+# Responses of get_daily_prediction_pair, keyed by (sandbox mode, sandbox game ID or today's date)
+DAILY_PAIR_CACHE_TTL_SECONDS = 60
+_daily_pair_cache: TTLCache = TTLCache(maxsize=8, ttl=DAILY_PAIR_CACHE_TTL_SECONDS)
+_daily_pair_cache_lock = threading.Lock() # Sync endpoint runs in the threadpool
+
 @router.get("/predictions/daily-pair", response_model=DailyPredictionPairResponse)
 def get_daily_prediction_pair():
     """
@@ -336,6 +363,17 @@ def get_daily_prediction_pair():
     fetch_mode = "standard" # Default mode
     target_game_info = "today's scheduled game" # Default target description
 
+    # The pair only changes with the date (or the sandbox game), so it is served from
+    # memory for every request within the TTL
+    sandbox_mode = is_sandbox_mode()
+    sandbox_game_id = get_current_sandbox_game_id() if sandbox_mode else None
+    cache_key = (sandbox_mode, sandbox_game_id or date.today().isoformat())
+    with _daily_pair_cache_lock:
+        cached_pair = _daily_pair_cache.get(cache_key)
+    if cached_pair is not None:
+        logger.info(f"Serving cached daily prediction pair {cached_pair.pair_id}")
+        return cached_pair
+
     try:
         # Get client, ensuring it's initialized
         current_supabase_client = get_supabase_anon_client() # Use getter function
@@ -344,9 +382,8 @@ def get_daily_prediction_pair():
         raise HTTPException(status_code=503, detail="Database connection setup error.") from None
 
     # --- Sandbox Check ---
-    if is_sandbox_mode():
+    if sandbox_mode:
         logger.info("App is in Sandbox mode (DEV). Checking for specific game ID.")
-        sandbox_game_id = get_current_sandbox_game_id()
         if sandbox_game_id is not None:
             fetch_mode = "sandbox"
             target_game_info = f"sandbox game ID {sandbox_game_id}"
@@ -385,91 +422,56 @@ def get_daily_prediction_pair():
         # TODO: Determine game_table_name dynamically if needed, assuming asx_games for now
         game_table_name = "asx_games"
         try:
-            # Add more detailed debugging
-            logger.debug(f"Executing query: game_date={today_str}, status=scheduled in table {game_table_name}")
-            
-            # Try with proper error handling
+            # One round trip picks the best game: today's scheduled game, else today's
+            # game in any status, else the most recent game (see get_best_daily_game in
+            # migration_docs PREDICTIONS_SQL).
+            logger.debug(f"Executing get_best_daily_game for {today_str} on table {game_table_name}")
             try:
-                response = current_supabase_client.table(game_table_name) \
-                             .select("id, game_date, exchange, company_a_ticker, company_a_name, company_b_ticker, company_b_name") \
-                             .eq("game_date", today_str) \
-                             .eq("status", "scheduled") \
-                             .limit(1) \
-                             .execute()
-                             
-                logger.debug(f"Raw Supabase response: {response}")
-                logger.debug(f"Response data: {response.data if hasattr(response, 'data') else 'No data attribute'}")
+                response = current_supabase_client.rpc("get_best_daily_game", {"p_today": today_str}).execute()
+                logger.debug(f"get_best_daily_game rows={len(response.data or [])}")
             except Exception as query_err:
                 logger.error(f"Error executing Supabase query: {query_err}")
                 raise
             
-            if response and hasattr(response, 'data') and response.data and len(response.data) > 0:
+            if response.data:
                 game_data = response.data[0]  # First result
-                logger.info(f"Successfully found game with ID: {game_data.get('id')}")
-            else:
-                # Try fallback strategies
-                logger.info("No scheduled games found for today, checking any game status...")
-                
-                # Try any status for today
-                try:
-                    fallback_response = current_supabase_client.table(game_table_name) \
-                                 .select("id, game_date, exchange, company_a_ticker, company_a_name, company_b_ticker, company_b_name") \
-                                 .eq("game_date", today_str) \
-                                 .limit(1) \
-                                 .execute()
-                except Exception as fallback_err:
-                    logger.error(f"Error executing fallback query: {fallback_err}")
-                    raise
-                
-                if fallback_response and hasattr(fallback_response, 'data') and fallback_response.data and len(fallback_response.data) > 0:
-                    game_data = fallback_response.data[0]  # First result
-                    logger.info(f"Found fallback game with ID: {game_data.get('id')}")
+                if game_data.get("game_date") != today_str:
+                    logger.info(f"No games found for today, using most recent available game with ID: {game_data.get('id')}")
+                elif game_data.get("status") != "scheduled":
+                    logger.info(f"No scheduled games found for today, found fallback game with ID: {game_data.get('id')}")
                     
                     # Update the game status to scheduled for future consistency
                     try:
-                        update_response = current_supabase_client.table(game_table_name) \
-                            .update({"status": "scheduled"}) \
+                        # return=minimal: we already hold the row, so skip echoing it back
+                        current_supabase_client.table(game_table_name) \
+                            .update({"status": "scheduled"}, returning=ReturnMethod.minimal) \
                             .eq("id", game_data.get('id')) \
                             .execute()
-                        logger.info(f"Updated fallback game status to scheduled: {update_response}")
+                        logger.info(f"Updated fallback game {game_data.get('id')} status to scheduled")
                     except Exception as update_err:
                         logger.warning(f"Failed to update game status: {update_err}")
                         # Continue anyway since we have the game data
                 else:
-                    # Try latest game from previous days if nothing for today
-                    logger.info("No games found for today, checking recent games...")
-                    try:
-                        recent_response = current_supabase_client.table(game_table_name) \
-                                     .select("id, game_date, exchange, company_a_ticker, company_a_name, company_b_ticker, company_b_name") \
-                                     .order("game_date", desc=True) \
-                                     .limit(1) \
-                                     .execute()
-                    except Exception as recent_err:
-                        logger.error(f"Error executing recent games query: {recent_err}")
-                        raise
-                                     
-                    if recent_response and hasattr(recent_response, 'data') and recent_response.data and len(recent_response.data) > 0:
-                        game_data = recent_response.data[0]  # First result
-                        logger.info(f"Using most recent available game with ID: {game_data.get('id')}")
-                    else:
-                        # Use test data if in development mode and no data found anywhere
-                        if mode == Mode.DEV:
-                            logger.warning("No game found in database, using test data for DEV mode")
-                            # Create test data for development
-                            game_data = {
-                                "id": str(uuid.uuid4()),
-                                "game_date": today_str,
-                                "exchange": "NYSE",
-                                "company_a_ticker": "AAPL",
-                                "company_a_name": "Apple Inc.",
-                                "company_b_ticker": "MSFT", 
-                                "company_b_name": "Microsoft Corporation",
-                                "status": "scheduled"
-                            }
-                            logger.info(f"Created test game data with ID: {game_data.get('id')}")
-                        else:
-                            logger.warning(f"No game found for today or recent days in {game_table_name}")
-                            raise Exception("No game data found")
+                    logger.info(f"Successfully found game with ID: {game_data.get('id')}")
+            else:
+                # Use test data if in development mode and no data found anywhere
+                if mode == Mode.DEV:
+                    logger.warning("No game found in database, using test data for DEV mode")
+                    # Create test data for development
+                    game_data = {
+                        "id": str(uuid.uuid4()),
+                        "game_date": today_str,
+                        "exchange": "NYSE",
+                        "company_a_ticker": "AAPL",
+                        "company_a_name": "Apple Inc.",
+                        "company_b_ticker": "MSFT", 
+                        "company_b_name": "Microsoft Corporation",
+                        "status": "scheduled"
+                    }
+                    logger.info(f"Created test game data with ID: {game_data.get('id')}")
+                else:
+                    logger.warning(f"No game found for today or recent days in {game_table_name}")
+                    raise Exception("No game data found")
         except Exception as e:
             logger.exception(f"Error querying Supabase for standard daily game on {today_str}: {e}")
             # In development mode, provide fallback test data
@@ -528,12 +530,15 @@ def get_daily_prediction_pair():
                 logger.error(f"Invalid date format in fetched game data ('{game_data.get('game_date')}'). Falling back to today. Error: {date_err}")
                 prediction_date = date.today()  # Fallback
 
-            return DailyPredictionPairResponse(
+            daily_pair = DailyPredictionPairResponse(
                 pair_id=pair_id,
                 company_a=company_a,
                 company_b=company_b,
                 prediction_date=prediction_date
             )
+            with _daily_pair_cache_lock:
+                _daily_pair_cache[cache_key] = daily_pair
+            return daily_pair
         except Exception as process_err:
             logger.exception(f"Error processing game data: {process_err}")
             # Last resort fallback - create a completely synthetic response regardless of environment
@@ -547,15 +552,15 @@ def get_daily_prediction_pair():
 
 
 @router.post("/predictions/process-results", status_code=200)
-async def process_game_results(request: ProcessResultsRequest, current_user_id: str = Depends(require_permission(Permissions.MANAGE_GAMES))):
+async def process_game_results(request: ProcessResultsRequest, background_tasks: BackgroundTasks, current_user_id: str = Depends(require_permission(Permissions.MANAGE_GAMES))):
     """
     Processes the results for a given game date and exchange.
     1. Fetches game details.
     2. Uses yfinance to determine the winner.
-    3. Updates the game table with the winner.
-    4. Calculates market timings and prediction time taken.
-    5. Updates associated predictions with correctness and time.
-    6. Placeholder for triggering leaderboard update.
+    3. Calculates market timings (game start).
+    4. Updates the game table with the winner and the associated predictions with
+       correctness and time taken, in a single RPC.
+    5. Queues the leaderboard update as a background task, so the response doesn't wait on it.
     """
     logger.info(f"Processing results for date: {request.game_date_str}, exchange: {request.exchange}")
     supabase_admin = get_supabase_admin_client()
@@ -565,24 +570,33 @@ async def process_game_results(request: ProcessResultsRequest, current_user_id:
     game_table_name = f"{exchange.lower()}_games"
 
     try:
-        # 1. Fetch game details
-        game_response = supabase_admin.table(game_table_name) \
-            .select("id, game_date, company_a_ticker, company_b_ticker, actual_winner_ticker") \
+        # 1. Check whether the game exists and is already processed, fetching only the winner column
+        check_response = supabase_admin.table(game_table_name) \
+            .select("actual_winner_ticker") \
             .eq("game_date", request.game_date_str) \
             .limit(1) \
-            .single() \
+            .maybe_single() \
             .execute()
-        game_data = game_response.data
-        logger.debug(f"Fetched game data: {game_data}")
+        check_data = check_response.data if check_response else None
 
-        if not game_data:
+        if not check_data:
             logger.warning(f"No game found for date {request.game_date_str} and exchange {exchange}")
             raise HTTPException(status_code=404, detail="Game not found for the specified date and exchange.")
 
-        if game_data.get("actual_winner_ticker"):
-             logger.info(f"Results already processed for game {game_data['pair_id']} on {game_data['game_date']}.")
+        if check_data.get("actual_winner_ticker"):
+             logger.info(f"Results already processed for {exchange} game on {request.game_date_str}.")
              return {"message": "Results already processed for this game."}
 
+        # Fetch game details
+        game_response = supabase_admin.table(game_table_name) \
+            .select("id, game_date, company_a_ticker, company_b_ticker") \
+            .eq("game_date", request.game_date_str) \
+            .limit(1) \
+            .single() \
+            .execute()
+        game_data = game_response.data
+        logger.debug(f"Fetched game data: {game_data}")
+
         ticker_a = game_data['company_a_ticker']
         ticker_b = game_data['company_b_ticker']
         pair_id = game_data['id']  # Changed from 'pair_id' to 'id'
@@ -610,16 +624,16 @@ async def process_game_results(request: ProcessResultsRequest, current_user_id:
         else:
             # Use yfinance for automatic results
             try:
-                end_date = game_date + timedelta(days=1)
-                data_a = yf.download(ticker_a, start=game_date, end=end_date, progress=False)
-                data_b = yf.download(ticker_b, start=game_date, end=end_date, progress=False)
+                prices_a, prices_b = await _get_pair_open_close(supabase_admin, exchange, ticker_a, ticker_b, game_date)
 
                 # Check for valid data and non-zero open price before calculating performance
-                if data_a.empty or data_b.empty or 'Open' not in data_a or 'Close' not in data_a or 'Open' not in data_b or 'Close' not in data_b or data_a['Open'].iloc[0] == 0 or data_b['Open'].iloc[0] == 0:
+                if not prices_a or not prices_b or prices_a[0] == 0 or prices_b[0] == 0:
                     logger.error(f"Could not fetch valid yfinance data or zero open price for {ticker_a} or {ticker_b} on {game_date}")
                 else:
-                    perf_a = (data_a['Close'].iloc[-1] - data_a['Open'].iloc[0]) / data_a['Open'].iloc[0] * 100  # Convert to percentage
-                    perf_b = (data_b['Close'].iloc[-1] - data_b['Open'].iloc[0]) / data_b['Open'].iloc[0] * 100  # Convert to percentage
+                    open_a, close_a = prices_a
+                    open_b, close_b = prices_b
+                    perf_a = (close_a - open_a) / open_a * 100  # Convert to percentage
+                    perf_b = (close_b - open_b) / open_b * 100  # Convert to percentage
                     logger.info(f"Performance on {game_date}: {ticker_a}={perf_a:.4f}%, {ticker_b}={perf_b:.4f}%")
 
                     if perf_a > perf_b: actual_winner = ticker_a
@@ -630,129 +644,47 @@ async def process_game_results(request: ProcessResultsRequest, current_user_id:
             except Exception as yf_err:
                 logger.exception(f"Error fetching/processing yfinance data: {yf_err}")
 
-        # 3. Update game table
-        if actual_winner:
-            try:
-                update_payload = {"actual_winner_ticker": actual_winner}
-                # Add performance values if available
-                if perf_a is not None:
-                    update_payload["company_a_performance"] = perf_a
-                if perf_b is not None:
-                    update_payload["company_b_performance"] = perf_b
-                    
-                update_game_response = supabase_admin.table(game_table_name) \
-                    .update(update_payload) \
-                    .eq("id", str(pair_id)) \
-                    .execute()
-                if update_game_response.data:
-                     logger.info(f"Updated {game_table_name} with winner {actual_winner} for {pair_id}")
-                else:
-                     # Check for specific error information if available
-                     error_info = getattr(update_game_response, 'error', 'No error info')
-                     logger.error(f"Failed to update {game_table_name} winner for {pair_id}. Error: {error_info}")
-            except Exception as db_err:
-                logger.exception(f"DB Error updating {game_table_name} winner for {pair_id}: {db_err}")
-
-        # 4. Calculate market timings
-        tz_map = {"ASX": "Australia/Sydney", "NYSE": "America/New_York"}
-        exchange_tz_str = tz_map.get(exchange)
+        # 3. Calculate market timings: the game starts at the previous trading session's
+        # close, taken from the exchange calendar so weekends and holidays are skipped
+        market_calendar = _MARKET_CALENDARS.get(exchange)
         game_start_utc = None
-        if exchange_tz_str:
-            try:
-                exchange_tz = pytz.timezone(exchange_tz_str)
-                prev_day = game_date - timedelta(days=1)
-                # Simple check for weekend, needs refinement for holidays
-                while prev_day.weekday() >= 5: prev_day -= timedelta(days=1)
-                # TODO: Use accurate market calendar (e.g., trading_calendars library)
-                game_start_local = datetime.combine(prev_day, time(16, 0), tzinfo=exchange_tz) # Approx 4 PM market close previous day
-                game_start_utc = game_start_local.astimezone(pytz.utc)
-                logger.info(f"Estimated Game Start UTC: {game_start_utc}")
-            except Exception as tz_err:
-                logger.exception(f"Error calculating game start time for {exchange}: {tz_err}")
-        else:
-             logger.error(f"Timezone not configured for exchange: {exchange}. Cannot calculate time_taken.")
-
-        # 5. Update predictions
-        predictions_response = supabase_admin.table("predictions") \
-            .select("prediction_id, user_id, predicted_ticker, submission_timestamp_utc") \
-            .eq("pair_id", pair_id) \
-            .filter("is_correct", "is", None) \
-            .execute() # Corrected: Ensure no trailing backslash if it's the last line
-
-        predictions_data = predictions_response.data
-        logger.info(f"Found {len(predictions_data)} unprocessed predictions for pair_id {pair_id}")
-
-        updates_to_perform = []
-        for pred in predictions_data:
-            is_correct = None
-            if actual_winner and actual_winner != "TIE":
-                is_correct = (pred['predicted_ticker'] == actual_winner)
-            elif actual_winner == "TIE":
-                 is_correct = False # Ties count as incorrect
-
-            time_taken_secs = None
-            if game_start_utc and pred.get('submission_timestamp_utc'): # Check if timestamp exists
-                 try:
-                     submission_utc_str = pred['submission_timestamp_utc']
-                     # Ensure the string has timezone info for consistent parsing
-                     if '+' not in submission_utc_str and 'Z' not in submission_utc_str.upper():
-                         submission_utc_str += '+00:00' # Assume UTC if missing
-                     submission_utc = pd.to_datetime(submission_utc_str).tz_convert(pytz.utc)
-
-                     if submission_utc >= game_start_utc:
-                         time_diff = submission_utc - game_start_utc
-                         time_taken_secs = time_diff.total_seconds()
-                     else:
-                         # Prediction submitted before market close of previous day? Set time to 0.
-                         logger.warning(f"Pred {pred['prediction_id']} submitted BEFORE game start {game_start_utc}. time_taken=0.0")
-                         time_taken_secs = 0.0
-                 except Exception as time_calc_err:
-                      logger.exception(f"Error calculating time_taken for pred {pred['prediction_id']} (Timestamp: {pred.get('submission_timestamp_utc')}): {time_calc_err}")
-
-            updates_to_perform.append({
-                "prediction_id": pred['prediction_id'],
-                "is_correct": is_correct,
-                "time_taken_secs": time_taken_secs
-            })
-
-        # Batch update predictions
-        update_count = 0
-        update_errors = 0
-        for update_data in updates_to_perform:
-            pred_id = update_data.pop("prediction_id")
-            # Prepare payload, removing keys with None values
-            update_payload = {k: v for k, v in update_data.items() if v is not None}
-
-            if not update_payload:
-                logger.debug(f"Skipping update for pred {pred_id}, payload empty after None filter.")
-                continue
-
+        if market_calendar is not None:
             try:
-                update_pred_resp = supabase_admin.table("predictions") \
-                    .update(update_payload) \
-                    .eq("prediction_id", pred_id) \
-                    .execute()
-                # Check response data count for success indication
-                if update_pred_resp.data and len(update_pred_resp.data) > 0:
-                     update_count += 1
+                sessions = market_calendar.schedule(start_date=game_date - timedelta(days=10), end_date=game_date - timedelta(days=1))
+                if sessions.empty:
+                    logger.error(f"No trading sessions found for {exchange} before {game_date}. Cannot calculate time_taken.")
                 else:
-                    error_info = getattr(update_pred_resp, 'error', 'No data returned and no error info')
-                    logger.error(f"Failed update pred {pred_id} payload {update_payload}: {error_info}")
-                    update_errors += 1
-            except Exception as upd_err:
-                logger.exception(f"Error updating pred {pred_id} payload {update_payload}: {upd_err}")
-                update_errors += 1
-
-        logger.info(f"Updated {update_count} predictions for {pair_id}. Errors: {update_errors}.")
+                    game_start_utc = sessions['market_close'].iat[-1].to_pydatetime() # market_close is UTC
+                    logger.info(f"Game Start UTC (previous session close): {game_start_utc}")
+            except Exception as cal_err:
+                logger.exception(f"Error calculating game start time for {exchange}: {cal_err}")
+        else:
+             logger.error(f"Market calendar not configured for exchange: {exchange}. Cannot calculate time_taken.")
 
-        # 6. Trigger leaderboard update
+        # 4. Record the winner and score the pair's unprocessed predictions (correctness and
+        # time taken) in one round trip (process_pair_results in migration_docs PREDICTIONS_SQL)
+        update_count = 0
+        try:
+            results_response = supabase_admin.rpc("process_pair_results", {
+                "p_exchange": exchange,
+                "p_pair_id": str(pair_id),
+                "p_winner": actual_winner,
+                "p_perf_a": perf_a,
+                "p_perf_b": perf_b,
+                "p_game_start": game_start_utc.isoformat() if game_start_utc else None,
+            }).execute()
+            update_count = results_response.data or 0
+            if actual_winner:
+                logger.info(f"Updated {game_table_name} with winner {actual_winner} for {pair_id}")
+        except Exception as db_err:
+            logger.exception(f"DB Error processing results for {game_table_name} pair {pair_id}: {db_err}")
+
+        logger.info(f"Updated {update_count} predictions for {pair_id}.")
+
+        # 5. Queue leaderboard update (runs after the response is sent)
         if update_count > 0:
-            logger.info(f"Triggering leaderboard update for exchange {exchange}...")
-            try:
-                await _update_all_time_leaderboard(exchange, game_date)
-                logger.info(f"Leaderboard successfully updated for exchange {exchange}")
-            except Exception as le:
-                logger.exception(f"Error updating leaderboard for {exchange}: {le}")
+            logger.info(f"Queueing leaderboard update for exchange {exchange}...")
+            background_tasks.add_task(_run_leaderboard_update, exchange, game_date)
 
         return {"message": f"Processed results for {pair_id}. Winner: {actual_winner or 'Not determined'}. Updated {update_count} predictions."}
 
@@ -798,41 +730,21 @@ async def submit_prediction(prediction_req: PredictionRequest, user_info: tuple
     try:
         supabase_admin = get_supabase_admin_client() # Use admin client for insert
         logger.info(f"Attempting to insert prediction {prediction_id} into Supabase...") # Added log
-        response = supabase_admin.table("predictions").insert(prediction_data).execute()
+        # INSERT ... ON CONFLICT (user_id, pair_id) DO NOTHING: a duplicate prediction comes
+        # back as an empty result instead of a unique-violation error.
+        # The client is synchronous; run the insert in a worker thread so this async
+        # endpoint doesn't block the event loop while waiting on Supabase
+        response = await asyncio.to_thread(
+            supabase_admin.table("predictions")
+                .upsert(prediction_data, on_conflict="user_id,pair_id", ignore_duplicates=True)
+                .execute
+        )
 
-        logger.debug(f"Supabase insert response for pred {prediction_id}: {response}")
+        logger.debug(f"Supabase insert for pred {prediction_id} returned {len(response.data or [])} rows")
 
-        # Improved error handling based on Supabase response structure
-        if hasattr(response, 'error') and response.error:
-             error_message = str(response.error.message) if hasattr(response.error, 'message') else str(response.error)
-             logger.error(f"Supabase error inserting pred {prediction_id} for user {user_id}: {error_message}")
-             # Check specifically for unique constraint violation on (user_id, pair_id)
-             # Adjust constraint name based on your actual DB schema if different
-             if "duplicate key value violates unique constraint" in error_message and ("predictions_user_id_pair_id_key" in error_message or "unique_user_pair" in error_message):
-                 raise HTTPException(status_code=409, detail="You have already submitted a prediction for this pair today.")
-             # Raise a generic 500 for other DB errors
-             raise HTTPException(status_code=500, detail=f"Failed to store prediction due to a database error.")
-        # Check if data was actually returned, indicating successful insert
-        elif not response.data:
-             logger.error(f"Supabase insert for pred {prediction_id} returned no data and no error. Assuming failure.")
-             raise HTTPException(status_code=500, detail="Failed to confirm prediction storage.")
-
-        # Improved error handling based on Supabase response structure
-        if hasattr(response, 'error') and response.error:
-             error_message = str(response.error.message) if hasattr(response.error, 'message') else str(response.error)
-             # Log the specific Supabase error *before* raising HTTPException
-             logger.error(f"Supabase insert failed for pred {prediction_id}. Supabase Error: {error_message}") # Added specific log
-             # Check specifically for unique constraint violation on (user_id, pair_id)
-             # Adjust constraint name based on your actual DB schema if different
-             if "duplicate key value violates unique constraint" in error_message and ("predictions_user_id_pair_id_key" in error_message or "unique_user_pair" in error_message):
-                 raise HTTPException(status_code=409, detail="You have already submitted a prediction for this pair today.")
-             # Raise a generic 500 for other DB errors
-             raise HTTPException(status_code=500, detail="Failed to store prediction due to a database error.")
-        # Check if data was actually returned, indicating successful insert
-        elif not response.data:
-             # Log this specific condition before raising
-             logger.error(f"Supabase insert for pred {prediction_id} returned no data and no error. Treating as failure.") # Added specific log
-             raise HTTPException(status_code=500, detail="Failed to confirm prediction storage.")
+        if not response.data:
+            logger.info(f"User {user_id} already submitted a prediction for pair {prediction_req.pair_id}.")
+            raise HTTPException(status_code=409, detail="You have already submitted a prediction for this pair today.")
 
         logger.info(f"Stored prediction {prediction_id} for user {user_id}.")
 
@@ -853,40 +765,47 @@ async def submit_prediction(prediction_req: PredictionRequest, user_info: tuple
 
 # --- Endpoint for Next Game Clue ---
 
+# Clue returned in DEV mode when there is no game data at all
+DEV_MOCK_NEXT_CLUE = "Next day will feature companies from the Healthcare Equipment sector"
+
+# Responses of get_next_game_clue, keyed by (game table, today's date). The clue only
+# changes when a game is generated, so frontend polls are served from memory.
+NEXT_CLUE_CACHE_TTL_SECONDS = 300
+_next_clue_cache: TTLCache = TTLCache(maxsize=8, ttl=NEXT_CLUE_CACHE_TTL_SECONDS)
+_next_clue_cache_lock = threading.Lock() # Sync endpoint runs in the threadpool
+
 @router.get("/predictions/next-clue", response_model=NextClueResponse)
 def get_next_game_clue():
     """
     Retrieves the next_day_clue from the most recent game record on or before today.
     Returns the clue if found, otherwise null.
     """
+    today_str = date.today().isoformat()
+    game_table_name = "asx_games" # Assuming ASX for now
+
+    cache_key = (game_table_name, today_str)
+    with _next_clue_cache_lock:
+        cached_clue = _next_clue_cache.get(cache_key)
+    if cached_clue is not None:
+        logger.debug(f"Serving cached next_day_clue for {today_str}")
+        return cached_clue
+
     try:
         current_supabase_client = get_supabase_anon_client()
     except Exception as e:
          logger.error(f"Supabase client not available for getting next clue: {e}")
          raise HTTPException(status_code=503, detail="Database connection not available.")
 
-    today_str = date.today().isoformat()
     logger.info(f"Attempting to retrieve next_day_clue based on date: {today_str}")
 
-    game_table_name = "asx_games" # Assuming ASX for now
-
     try:
-        # First try to get today's game
+        # Most recent game on or before today (today's game if there is one), in one round trip
         response = current_supabase_client.table(game_table_name) \
                          .select("next_day_clue") \
-                         .eq("game_date", today_str) \
+                         .lte("game_date", today_str) \
+                         .order("game_date", desc=True) \
                          .limit(1) \
                          .execute()
-        
-        # If today's game not found, try to get the most recent game
-        game_data_list = response.data
-        if not game_data_list or len(game_data_list) == 0:
-            logger.info(f"No game found for today ({today_str}), looking for the most recent game")
-            response = current_supabase_client.table(game_table_name) \
-                             .select("next_day_clue") \
-                             .order("game_date", desc=True) \
-                             .limit(1) \
-                             .execute()
 
         logger.debug(f"Supabase response for next clue query from {game_table_name}: {response}")
 
@@ -912,14 +831,16 @@ def get_next_game_clue():
             logger.warning(f"No game data found in {game_table_name} for date {today_str} to retrieve clue.")
             # Only provide mock data if no real data exists anywhere in the table
             if not response.data or len(response.data) == 0:
-                from app.env import Mode, mode
                 if mode == Mode.DEV:
-                    clue = "Next day will feature companies from the Healthcare Equipment sector"
+                    clue = DEV_MOCK_NEXT_CLUE
                     logger.info(f"Using mock clue for testing in DEV mode: {clue}")
         else:
             logger.warning(f"Unexpected Supabase response format for next clue (expected list): {game_data_list}")
 
-        return NextClueResponse(next_day_clue=clue)
+        clue_response = NextClueResponse(next_day_clue=clue)
+        with _next_clue_cache_lock:
+            _next_clue_cache[cache_key] = clue_response
+        return clue_response
 
     except HTTPException as http_err:
         # Re-raise specific HTTPExceptions
@@ -4,7 +4,11 @@ This module provides documentation for the necessary configurations
 that must be verified before deploying the Munymo application to production.
 """
 
+from types import MappingProxyType
+
+import orjson
 from fastapi import APIRouter
+from fastapi.responses import Response
 
 # Create a router for this API
 router = APIRouter(prefix="/production-checklist", tags=["Admin"])
@@ -69,8 +73,8 @@ POST_DEPLOYMENT_CHECKS = [
     "Confirm push notifications are working properly"
 ]
 
-# Combined list of all checks for easy iteration
-ALL_CHECKS = {
+# Combined list of all checks for easy iteration (read-only)
+ALL_CHECKS = MappingProxyType({
     "Firebase": FIREBASE_CHECKS,
     "Supabase": SUPABASE_CHECKS,
     "Stripe": STRIPE_CHECKS,
@@ -79,7 +83,10 @@ ALL_CHECKS = {
     "Security": SECURITY_CHECKS,
     "Testing": TESTING_CHECKS,
     "Post-Deployment": POST_DEPLOYMENT_CHECKS
-}
+})
+
+# The checklist is static, so its JSON body is encoded once at import
+_CHECKLIST_JSON = orjson.dumps(dict(ALL_CHECKS))
 
 
 def print_checklist():
@@ -95,10 +102,10 @@ def print_checklist():
     print("Instructions: Mark each item as [x] when verified.")
 
 
-@router.get("/")
+@router.get("/", response_class=Response)
 def get_production_checklist():
     """Get the production configuration checklist"""
-    return ALL_CHECKS
+    return Response(content=_CHECKLIST_JSON, media_type="application/json")
 
 
 if __name__ == "__main__":
@@ -7,9 +7,15 @@ from pydantic import BaseModel
 import databutton as db
 import yfinance as yf
 import pandas as pd
+import numpy as np
 from datetime import datetime, timezone, date, timedelta
 import re
 from typing import List, Dict, Any
+import threading
+import html
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TLRUCache
 
 from app.apis.predictions_api import get_supabase_client, logger # Import Supabase client and logger
 from app.apis.fcm import send_fcm_notification # Import FCM notification function
@@ -22,9 +28,58 @@ router = APIRouter(prefix="/results", tags=["Results"])
 
 # --- Helper Functions ---
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9._-]')
+
 def sanitize_storage_key(key: str) -> str:
     """Sanitize storage key to only allow alphanumeric and ._- symbols"""
-    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+    return _SANITIZE_RE.sub('', key)
+
+# Market data for a closed date range never changes, so downloads are kept for a day;
+# a range that reaches today may still move and is kept only briefly.
+YF_HISTORICAL_CACHE_TTL_SECONDS = 24 * 60 * 60
+YF_RECENT_CACHE_TTL_SECONDS = 5 * 60
+
+def _yf_cache_ttu(key, value, now):
+    _, _, end_date_str = key
+    # yf end dates are exclusive, so the range is closed once end <= today
+    closed = date.fromisoformat(end_date_str) <= date.today()
+    return now + (YF_HISTORICAL_CACHE_TTL_SECONDS if closed else YF_RECENT_CACHE_TTL_SECONDS)
+
+_yf_download_cache: TLRUCache = TLRUCache(maxsize=256, ttu=_yf_cache_ttu)
+_yf_download_cache_lock = threading.Lock() # Sync endpoint runs in the threadpool
+
+def _cached_download(tickers: List[str], start_date_str: str, end_date_str: str) -> pd.DataFrame:
+    """yf.download for the given tickers and date range, cached per (tickers, start, end)."""
+    cache_key = (tuple(sorted(tickers)), start_date_str, end_date_str)
+    with _yf_download_cache_lock:
+        cached_data = _yf_download_cache.get(cache_key)
+    if cached_data is not None:
+        logger.info(f"Using cached yfinance data for {tickers} from {start_date_str} to {end_date_str}")
+        return cached_data
+
+    data = yf.download(tickers=tickers, start=start_date_str, end=end_date_str, progress=False)
+    # Empty frames are usually transient (data not published yet), so they are not cached
+    if not data.empty:
+        with _yf_download_cache_lock:
+            _yf_download_cache[cache_key] = data
+    return data
+
+# Upper bound on concurrent per-user notification sends in finalize_game_results
+NOTIFICATION_MAX_WORKERS = 32
+
+# Result email bodies, parsed once at import. Values substituted into the HTML body are
+# escaped by the caller.
+RESULT_EMAIL_TEXT_TEMPLATE = Template(
+    "Hello $user_id,\n\nHere are the results for today's Munymo prediction ($ticker_a vs $ticker_b):\n\n"
+    "$outcome_message\n$your_prediction_message\n\nThanks for playing!\n- The Munymo Team"
+)
+RESULT_EMAIL_HTML_TEMPLATE = Template("""\
+<p>Hello $user_id,</p>
+<p>Here are the results for today's Munymo prediction (<strong>$ticker_a</strong> vs <strong>$ticker_b</strong>):</p>
+<p>The winner was <strong>$actual_winner_ticker</strong>.</p>
+<p>$your_prediction_message</p>
+<p>Thanks for playing!<br/>- The Munymo Team</p>
+""")
 
 # --- Pydantic Models ---
 
@@ -92,10 +147,23 @@ def finalize_game_results(
         logger.error(f"Supabase client not available for processing results: {e}")
         raise HTTPException(status_code=503, detail="Database connection not available.")
 
+    # Steps 1 and 2 are independent lookups by pair_id, so both queries are sent at once.
+    # Leaving the pool joins both, so an error in either is raised once both have returned.
+    # They stay two queries rather than one embedded select: PostgREST embedding needs a
+    # foreign key from predictions.pair_id to asx_games, and none is declared (the column
+    # also holds nyse_games ids).
+    logger.info(f"Fetching game details and predictions for pair_id: {pair_id} from Supabase.")
+    with ThreadPoolExecutor(max_workers=2) as fetch_pool:
+        game_future = fetch_pool.submit(
+            supabase.table("asx_games").select("pair_id, game_date, company_a_ticker, company_b_ticker").eq("pair_id", pair_id).maybe_single().execute
+        )
+        predictions_future = fetch_pool.submit(
+            supabase.table("predictions").select("prediction_id, user_id, predicted_ticker, submission_timestamp_utc").eq("pair_id", pair_id).execute
+        )
+
     # --- Step 1: Fetch Game Details from Supabase 'asx_games' ---
-    logger.info(f"Fetching game details for pair_id: {pair_id} from Supabase 'asx_games' table.")
     try:
-        game_response = supabase.table("asx_games").select("pair_id, game_date, company_a_ticker, company_b_ticker").eq("pair_id", pair_id).maybe_single().execute()
+        game_response = game_future.result()
         if not game_response.data:
              logger.error(f"Game details not found in Supabase 'asx_games' for pair_id: {pair_id}")
              raise HTTPException(status_code=404, detail=f"Details for prediction pair '{pair_id}' not found in asx_games.")
@@ -118,9 +186,8 @@ def finalize_game_results(
         raise HTTPException(status_code=500, detail="Failed to retrieve game details.") from e
 
     # --- Step 2: Fetch User Predictions from Supabase 'predictions' ---
-    logger.info(f"Fetching predictions for pair_id: {pair_id} from Supabase 'predictions' table.")
     try:
-        predictions_response = supabase.table("predictions").select("prediction_id, user_id, predicted_ticker, submission_timestamp_utc").eq("pair_id", pair_id).execute()
+        predictions_response = predictions_future.result()
         user_predictions = predictions_response.data # This is a list of dicts
         logger.info(f"Fetched {len(user_predictions)} predictions from Supabase for pair {pair_id}")
 
@@ -159,7 +226,7 @@ def finalize_game_results(
         end_date_str = end_date_dt.isoformat()
 
         print(f"[INFO] Fetching yfinance data for {ticker_a}, {ticker_b} from {start_date_str} to {end_date_str}")
-        data = yf.download(tickers=[ticker_a, ticker_b], start=start_date_str, end=end_date_str, progress=False)
+        data = _cached_download([ticker_a, ticker_b], start_date_str, end_date_str)
 
         if data.empty:
             print(f"[WARN] yfinance returned empty DataFrame for tickers {ticker_a}, {ticker_b} and date range {start_date_str} to {end_date_str}.")
@@ -179,7 +246,6 @@ def finalize_game_results(
             raise ValueError("Market data for game date or prior not available.")
 
         actual_game_date_ts = game_day_data_index[-1]
-        game_day_data = data.loc[actual_game_date_ts]
 
         previous_trading_days_index = data.index[data.index < actual_game_date_ts]
         if previous_trading_days_index.empty:
@@ -187,17 +253,17 @@ def finalize_game_results(
              raise ValueError("Previous trading day market data not available.")
 
         prev_trading_date_ts = previous_trading_days_index[-1]
-        prev_day_data = data.loc[prev_trading_date_ts]
 
-        close_a_prev = prev_day_data[close_col_a]
-        close_a_game = game_day_data[close_col_a]
-        close_b_prev = prev_day_data[close_col_b]
-        close_b_game = game_day_data[close_col_b]
+        # Both tickers' closes for both days as one 2x2 array: rows (prev, game), columns (a, b)
+        closes = data['Close'][[ticker_a, ticker_b]].loc[[prev_trading_date_ts, actual_game_date_ts]].to_numpy(dtype=float)
+        prev_closes, game_closes = closes
+        close_a_prev, close_b_prev = prev_closes.tolist()
+        close_a_game, close_b_game = game_closes.tolist()
 
         print(f"[DEBUG] {ticker_a}: Prev Date={prev_trading_date_ts.date()}, Prev Close={close_a_prev}, Game Date Used={actual_game_date_ts.date()}, Game Close={close_a_game}")
         print(f"[DEBUG] {ticker_b}: Prev Date={prev_trading_date_ts.date()}, Prev Close={close_b_prev}, Game Date Used={actual_game_date_ts.date()}, Game Close={close_b_game}")
 
-        if pd.isna(close_a_prev) or pd.isna(close_a_game) or pd.isna(close_b_prev) or pd.isna(close_b_game):
+        if np.isnan(closes).any():
             print("[WARN] NaN value encountered in closing prices after lookup.")
             raise ValueError("Could not retrieve complete market data for comparison (NaN value encountered).")
 
@@ -206,12 +272,11 @@ def finalize_game_results(
 
         # --- Step 4: Determine Winner --- (This logic is now integrated within the yfinance block)
         print("[INFO] Determining winner based on yfinance performance")
-        if close_a_prev == 0 or close_b_prev == 0:
+        if (prev_closes == 0).any():
             print(f"[WARN] Zero baseline price detected for {pair_id}. Cannot calculate percentage change.")
             raise ValueError("Cannot calculate performance change due to zero baseline price.")
         else:
-            change_a = (close_a_game - close_a_prev) / close_a_prev
-            change_b = (close_b_game - close_b_prev) / close_b_prev
+            change_a, change_b = ((game_closes - prev_closes) / prev_closes).tolist()
             logger.info(f"[DEBUG] Change A: {change_a*100:.2f}%, Change B: {change_b*100:.2f}%")
 
             if change_a > change_b:
@@ -260,36 +325,7 @@ def finalize_game_results(
         # processed_at_utc is handled by default in Supabase
     }
 
-    try:
-        game_results_insert_response = supabase.table("game_results").insert(game_result_data).execute()
-        if not game_results_insert_response.data:
-            logger.error(f"Failed to insert game_results for {pair_id}. Response: {game_results_insert_response}")
-            raise HTTPException(status_code=500, detail="Failed to store game results in database.")
-        
-        inserted_game_result = game_results_insert_response.data[0]
-        result_id = inserted_game_result["result_id"]
-        logger.info(f"Stored game_results successfully for {pair_id}. Result ID: {result_id}")
-
-    except APIError as e:
-        # Handle potential unique constraint violation if processing is re-run
-        if e.code == '23505': # Unique violation
-            logger.warning(f"Game results for pair_id {pair_id} already exist. Fetching existing result_id. Error: {e.message}")
-            # Fetch the existing result_id to continue scoring users
-            try:
-                existing_result_response = supabase.table("game_results").select("result_id").eq("pair_id", pair_id).single().execute()
-                result_id = existing_result_response.data["result_id"]
-                logger.info(f"Fetched existing result_id: {result_id} for pair_id {pair_id}")
-            except Exception as fetch_e:
-                 logger.exception(f"Failed to fetch existing result_id for {pair_id} after unique violation: {fetch_e}")
-                 raise HTTPException(status_code=500, detail="Failed to retrieve existing game result after conflict.") from fetch_e
-        else:
-            logger.exception(f"Supabase API error inserting game_results for {pair_id}: {e}")
-            raise HTTPException(status_code=500, detail=f"Database error storing game results: {e.message}") from e
-    except Exception as e:
-        logger.exception(f"Unexpected error storing game_results for {pair_id}: {e}")
-        raise HTTPException(status_code=500, detail="Unexpected error storing game results.") from e
-
-    # 5b. Calculate and store user scores
+    # 5b. Calculate user scores (result_id is filled in by the database)
     user_scores_to_insert = []
     user_score_details_for_response = [] # For the final response model
     
@@ -300,7 +336,6 @@ def finalize_game_results(
         is_correct = (predicted_ticker == actual_winner_ticker)
         
         score_data = {
-            "result_id": result_id,
             "prediction_id": prediction_id,
             "user_id": user_id,
             "pair_id": pair_id, # Denormalized
@@ -319,24 +354,27 @@ def finalize_game_results(
         ))
         logger.debug(f"User {user_id} prediction {prediction_id} for {pair_id}. Predicted: {predicted_ticker}. Correct: {is_correct}")
 
-    if user_scores_to_insert:
-        logger.info(f"Attempting to insert {len(user_scores_to_insert)} user scores for result_id {result_id}.")
-        try:
-            # Use upsert with ignore_duplicates=True based on prediction_id unique constraint
-            # This handles re-running the processing without failing if scores already exist
-            user_scores_insert_response = supabase.table("user_scores").upsert(user_scores_to_insert, on_conflict="prediction_id", ignore_duplicates=True).execute()
-            # Check for errors in response (upsert might not raise APIError 23505 like insert)
-            # Note: Difficult to get precise count of inserted vs ignored rows easily from response
-            logger.info(f"Completed upsert for user_scores for result_id {result_id}. Response status: {user_scores_insert_response.status_code}")
-            # Add more robust checking if needed based on response structure
-
-        except APIError as e:
-            logger.exception(f"Supabase API error upserting user_scores for result {result_id}: {e}")
-            # Don't necessarily fail the whole process, but log it
-            # Allow process to return success, but log the scoring error
-        except Exception as e:
-            logger.exception(f"Unexpected error upserting user_scores for result {result_id}: {e}")
-            # Log error but maybe don't fail?
+    # 5c. Store the game result and user scores in one transaction (finalize_game_results in
+    # migration_docs RESULTS_SQL); a re-run reuses the existing result and skips existing scores
+    try:
+        finalize_response = supabase.rpc("finalize_game_results", {
+            "p_game": game_result_data,
+            "p_scores": user_scores_to_insert,
+        }).execute()
+        if not finalize_response.data:
+            logger.error(f"Failed to store game_results for {pair_id}. Response: {finalize_response}")
+            raise HTTPException(status_code=500, detail="Failed to store game results in database.")
+        result_id = finalize_response.data["result_id"]
+        logger.info(f"Stored game_results for {pair_id}. Result ID: {result_id}. Inserted {finalize_response.data['inserted_count']} of {len(user_scores_to_insert)} user scores.")
+
+    except HTTPException:
+        raise
+    except APIError as e:
+        logger.exception(f"Supabase API error storing results for {pair_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Database error storing game results: {e.message}") from e
+    except Exception as e:
+        logger.exception(f"Unexpected error storing game_results for {pair_id}: {e}")
+        raise HTTPException(status_code=500, detail="Unexpected error storing game results.") from e
 
     # Remove old storage logic
     # results_storage_key = sanitize_storage_key(f"results__{pair_id}")
@@ -356,16 +394,24 @@ def finalize_game_results(
     # Placeholder emails are fine for now, but user_id needs mapping to email eventually
     placeholder_recipient_email = "test@example.com" # Replace this!
     
-    # Use the user_score_details_for_response which matches the structure needed
-    for score_entry in user_score_details_for_response:
+    # Notification content shared by every user
+    subject = f"Munymo Result for {game_date.isoformat()}: {ticker_a} vs {ticker_b}"
+    outcome_message = f"The winner was {actual_winner_ticker}."
+    html_game_values = {
+        "ticker_a": html.escape(ticker_a),
+        "ticker_b": html.escape(ticker_b),
+        "actual_winner_ticker": html.escape(actual_winner_ticker),
+    }
+
+    # Each user's email and push are independent blocking calls, so users are notified in
+    # parallel; failures are caught per user and don't affect the others
+    def _notify_user(score_entry: UserScoreDetail):
         user_id = score_entry.user_id # Access via attribute now
         predicted_ticker = score_entry.predicted_ticker
         is_correct = score_entry.is_correct
         
         # Construct notification content
-        subject = f"Munymo Result for {game_date.isoformat()}: {ticker_a} vs {ticker_b}"
         result_text = "correctly" if is_correct else "incorrectly"
-        outcome_message = f"The winner was {actual_winner_ticker}."
         if predicted_ticker:
              your_prediction_message = f"You predicted {predicted_ticker} and were {result_text}."
         else:
@@ -373,15 +419,15 @@ def finalize_game_results(
 
         notification_body = f"{outcome_message} {your_prediction_message}"
         
-        content_text = f"Hello {user_id},\n\nHere are the results for today's Munymo prediction ({ticker_a} vs {ticker_b}):\n\n{outcome_message}\n{your_prediction_message}\n\nThanks for playing!\n- The Munymo Team"
-        
-        content_html = f"""\
-        <p>Hello {user_id},</p>
-        <p>Here are the results for today's Munymo prediction (<strong>{ticker_a}</strong> vs <strong>{ticker_b}</strong>):</p>
-        <p>The winner was <strong>{actual_winner_ticker}</strong>.</p>
-        <p>{your_prediction_message}</p>
-        <p>Thanks for playing!<br/>- The Munymo Team</p>
-        """
+        content_text = RESULT_EMAIL_TEXT_TEMPLATE.substitute(
+            user_id=user_id, ticker_a=ticker_a, ticker_b=ticker_b,
+            outcome_message=outcome_message, your_prediction_message=your_prediction_message
+        )
+        content_html = RESULT_EMAIL_HTML_TEMPLATE.substitute(
+            html_game_values,
+            user_id=html.escape(user_id),
+            your_prediction_message=html.escape(your_prediction_message)
+        )
 
         # Send email (using placeholder address for now)
         try:
@@ -420,6 +466,10 @@ def finalize_game_results(
             # Log error but don't fail the whole process if FCM notification fails
             logger.error(f"Failed to send FCM notification to user {user_id}: {e}")
             # Continue processing other users
+
+    with ThreadPoolExecutor(max_workers=NOTIFICATION_MAX_WORKERS) as notify_pool:
+        list(notify_pool.map(_notify_user, user_score_details_for_response))
+
     return ProcessResultsResponse(
         success=True,
         message=f"Successfully processed results for pair '{pair_id}'. Winner: {actual_winner_ticker}", 
@@ -458,30 +508,26 @@ def get_results_for_pair(
         # --- Format User Scores ---
         # The related user_scores are fetched directly due to the select("*, user_scores(*)") query
         user_scores_raw = game_result_data.get("user_scores", [])
+        # Submission timestamps live on the predictions table; fetch them for every score in
+        # one IN query rather than one query per score
+        prediction_ids = [score_raw["prediction_id"] for score_raw in user_scores_raw if score_raw.get("prediction_id")]
+        submission_ts_by_prediction = {}
+        if prediction_ids:
+            try:
+                preds_resp = supabase.table("predictions").select("prediction_id, submission_timestamp_utc").in_("prediction_id", prediction_ids).execute()
+                submission_ts_by_prediction = {pred["prediction_id"]: pred.get("submission_timestamp_utc") for pred in preds_resp.data or []}
+            except APIError as pred_e:
+                logger.error(f"Failed to fetch prediction timestamps for pair {pair_id}: {pred_e}")
+            except Exception as pred_e:
+                logger.exception(f"Unexpected error fetching prediction timestamps for pair {pair_id}: {pred_e}")
+
         user_scores_formatted = []
         for score_raw in user_scores_raw:
-            # Fetch submission timestamp from prediction table if needed and available
-            # This currently requires an additional query or joining in the original query if possible
-            # For now, we rely on what's in user_scores or potentially add submission_timestamp later
-            # Let's assume prediction details might be needed later, but focus on score structure now
-            # We need to fetch the submission_timestamp_utc from the predictions table
-            # Since it's not directly on user_scores, let's fetch it based on prediction_id if available
-            submission_ts = None
-            if score_raw.get("prediction_id"):
-                try:
-                    pred_resp = supabase.table("predictions").select("submission_timestamp_utc").eq("prediction_id", score_raw["prediction_id"]).maybe_single().execute()
-                    if pred_resp.data:
-                        submission_ts = pred_resp.data.get("submission_timestamp_utc")
-                except APIError as pred_e:
-                    logger.error(f"Failed to fetch prediction timestamp for pred_id {score_raw['prediction_id']}: {pred_e}")
-                except Exception as pred_e:
-                    logger.exception(f"Unexpected error fetching prediction timestamp for pred_id {score_raw['prediction_id']}: {pred_e}")
-
             user_scores_formatted.append(UserScoreDetail(
                 user_id=score_raw.get("user_id", "unknown_user"),
                 predicted_ticker=score_raw.get("predicted_ticker"), # Ensure this column exists in user_scores or fetch from prediction
                 is_correct=score_raw.get("is_correct", False),
-                submission_timestamp_utc=submission_ts, # Fetch from related prediction table
+                submission_timestamp_utc=submission_ts_by_prediction.get(score_raw.get("prediction_id")), # From related prediction
                 prediction_id=score_raw.get("prediction_id")
             ))
 
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends, Path
+from fastapi import APIRouter, HTTPException, Depends, Path, BackgroundTasks
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
 import traceback # For detailed error logging
@@ -348,7 +348,7 @@ async def trigger_close_predictions(current_user_id: str = Depends(require_permi
         raise HTTPException(status_code=500, detail=f"Unexpected error closing predictions: {e}") from e
 
 @router.post("/sandbox/trigger-process-results", response_model=TriggerResponse)
-async def trigger_process_results(current_user_id: str = Depends(require_permission(Permissions.MANAGE_SANDBOX))):
+async def trigger_process_results(background_tasks: BackgroundTasks, current_user_id: str = Depends(require_permission(Permissions.MANAGE_SANDBOX))):
     """Manually triggers the process_game_results logic for the current sandbox game. Only works in DEV mode."""
     print("[INFO] Received request to trigger process results.")
     if not is_sandbox_mode():
@@ -378,7 +378,7 @@ async def trigger_process_results(current_user_id: str = Depends(require_permiss
         process_request = ProcessResultsRequest(game_date_str=game_date_str, exchange=exchange)
         
         # Call the imported function
-        result = await process_game_results(request=process_request)
+        result = await process_game_results(request=process_request, background_tasks=background_tasks)
         
         message = f"Successfully triggered process_game_results for sandbox game {sandbox_game_id} ({game_date_str}, {exchange})."
         print(f"[INFO] {message}")
@@ -413,8 +413,8 @@ async def trigger_leaderboard_update(current_user_id: str = Depends(require_perm
         if not exchange:
             raise HTTPException(status_code=500, detail="Missing exchange from fetched game details.")
 
-        # TODO: Replace simulation with actual call when _update_all_time_leaderboard is available
-        # e.g., await _update_all_time_leaderboard(exchange=exchange)
+        # TODO: Replace simulation with actual call to _apply_leaderboard_delta
+        # e.g., await _apply_leaderboard_delta(exchange=exchange, game_date=game_date)
         simulation_message = f"SIMULATED leaderboard update trigger for exchange: {exchange}."
         print(f"[INFO] {simulation_message}")
         
@@ -3,6 +3,7 @@ import pathlib
 import json
 import dotenv
 from fastapi import FastAPI, APIRouter, Depends
+from fastapi.responses import ORJSONResponse
 
 dotenv.load_dotenv()
 
@@ -76,7 +77,7 @@ def get_firebase_config() -> dict | None:
 
 def create_app() -> FastAPI:
     """Create the app. This is called by uvicorn with the factory option to construct the app object."""
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
     app.include_router(import_api_routers())
 
     for route in app.routes: